@@ -15,10 +15,22 @@ class PixooStack(Stack):
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        # Seconds that SQS waits to gather messages into one consumer batch,
+        # the producer sends a new minute of messages every 60 seconds
+        batching_window = int(os.environ.get("BATCHING_WINDOW", "0"))
+        if not 0 <= batching_window < 60:
+            raise ValueError(
+                f"BATCHING_WINDOW must be from 0 to 59 seconds, not {batching_window}"
+            )
+
+        # The consumer waits for up to the batching window, before the last message
+        consumer_timeout = 10 + batching_window
+
         pixoo_queue = sqs.Queue(
             self,
             "PixooQueue",
-            visibility_timeout=Duration.seconds(60),
+            # SQS requires this to be at least the consumer's timeout
+            visibility_timeout=Duration.seconds(max(60, consumer_timeout)),
         )
 
         pixoo_bucket = s3.Bucket(
@@ -33,45 +45,74 @@ class PixooStack(Stack):
         lambda_props = {
             "runtime": _lambda.Runtime.PYTHON_3_14,
             "entry": "../local",
-            "timeout": Duration.seconds(10),
             "handler": "lambda_handler",
         }
 
-        # Lambda that is triggered by Cloudwatch
-        producer_lambda = PythonFunction(
-            self,
-            "Producer",
-            index="producer.py",
-            environment={
-                "QUEUE_URL": pixoo_queue.queue_url,
-            },
-            **lambda_props,
-        )
-        pixoo_queue.grant_send_messages(producer_lambda)
+        if "PIXOO_URL" not in os.environ and "PIXOO_URLS" not in os.environ:
+            raise ValueError(
+                "PIXOO_URL (or PIXOO_URLS for several devices) must be set"
+            )
 
         environment = {
-            "PIXOO_URL": os.environ["PIXOO_URL"],
             "BUCKET_NAME": pixoo_bucket.bucket_name,
             "TZ": "Europe/London",
             "LAMBDA_ENV": "true",
         }
 
         # Optional keys
-        for key in ["TFL_APP_KEY", "PROXY_URL", "MET_OFFICE_API_KEY"]:
+        for key in [
+            "PIXOO_URL",
+            "PIXOO_URLS",
+            "TFL_APP_KEY",
+            "PROXY_URL",
+            "MET_OFFICE_API_KEY",
+            "TRACE_FORMAT",
+        ]:
             if key in os.environ:
                 environment[key] = os.environ[key]
 
+        # Lambda that is triggered by Cloudwatch
+        producer_environment = {
+            "QUEUE_URL": pixoo_queue.queue_url,
+            "BATCHING_WINDOW": str(batching_window),
+        }
+        render_ahead = os.environ.get("RENDER_AHEAD", "false").lower() == "true"
+        if render_ahead:
+            # The producer renders the frames, so it needs everything the consumer does
+            producer_environment.update(environment, RENDER_AHEAD="true")
+        if os.environ.get("ADAPTIVE_SCHEDULE", "false").lower() == "true":
+            # The producer checks the departure boards, to decide how often to draw them
+            producer_environment.update(environment, ADAPTIVE_SCHEDULE="true")
+
+        producer_lambda = PythonFunction(
+            self,
+            "Producer",
+            index="producer.py",
+            environment=producer_environment,
+            timeout=Duration.seconds(10),
+            **lambda_props,
+        )
+        pixoo_queue.grant_send_messages(producer_lambda)
+        if render_ahead:
+            pixoo_bucket.grant_read_write(producer_lambda)
+
         # Lambda that is triggered by SQS
         consumer_lambda = PythonFunction(
             self,
             "Consumer",
             index="consumer.py",
             environment=environment,
+            timeout=Duration.seconds(consumer_timeout),
             **lambda_props,
         )
         pixoo_bucket.grant_read_write(consumer_lambda)
 
-        event_source = lambda_sources.SqsEventSource(pixoo_queue, batch_size=1)
+        event_source = lambda_sources.SqsEventSource(
+            pixoo_queue,
+            batch_size=10,
+            max_batching_window=Duration.seconds(batching_window),
+            report_batch_item_failures=True,
+        )
         consumer_lambda.add_event_source(event_source)
 
         # Trigger the producer lambda once per minute
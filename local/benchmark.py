@@ -0,0 +1,695 @@
+import argparse
+import base64
+import cProfile
+import json
+import os
+import pstats
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+import urllib3
+from cache import Cache, MemoryCache
+from checks import SYNTHETIC_STATIONS, _make_synthetic_rows
+from config import MessageMode
+from frames import pack_frames
+from html_table import find_row
+from parkrun import Parkrun, Runner
+from pen import Colours, Pen
+from PIL import Image
+from pixoo import Pixoo
+from stations import STATIONS, STATIONS_PATH, StationRegistry, Stations, _write_rows
+from tfl import TFL, parse_arrivals
+from tracing import Tracer
+
+# Recorded upstream responses, by the host that they came from
+FIXTURES = {
+    "api.tfl.gov.uk": "fixtures/tfl_arrivals.json",
+    "data.hub.api.metoffice.gov.uk": "fixtures/met_office_hourly.json",
+    "nw3weather.co.uk": "fixtures/nw3weather_pond.html",
+    "www.parkrun.org.uk": "fixtures/parkrun_runner.html",
+}
+
+COLD_START_SCRIPT = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import consumer
+
+imported = time.perf_counter()
+consumer.handlers.get(sys.argv[1])
+consumer.handlers.devices
+initialised = time.perf_counter()
+print(json.dumps({"import": imported - start, "init": initialised - imported}))
+"""
+
+
+def _time(fn, repeats=1000):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    end = time.perf_counter()
+    return 1e6 * (end - start) / repeats
+
+
+def _legacy_encode_image(image: Image):
+    pixels = []
+    for red, green, blue in image.getdata():
+        pixels.extend([red, green, blue])
+
+    return base64.b64encode(bytearray(pixels)).decode("utf-8")
+
+
+def benchmark_encode_image():
+    image = Image.new("RGB", (64, 64), color=Colours.GRAY)
+    if _legacy_encode_image(image) != Pixoo.encode_image(image):
+        raise ValueError("The legacy and current encoders disagree")
+
+    legacy = _time(lambda: _legacy_encode_image(image))
+    current = _time(lambda: Pixoo.encode_image(image))
+    print(f"encode_image: legacy {legacy:.1f}us, current {current:.1f}us")
+
+
+def _legacy_draw_text(pen, image, xy, text, color):
+    x, y = xy
+    for char in text.upper():
+        if char == " ":
+            x += 2
+            continue
+
+        glyph = pen.glyphs[char]
+        background = Image.new("RGBA", glyph.size, color=color)
+        image.paste(background, (x, y), glyph)
+
+        x += glyph.width + 1
+
+
+def _render_text_frame(draw_text, new_image=None):
+    if new_image is None:
+        image = Image.new("RGB", (64, 64), color=Colours.GRAY)
+    else:
+        image = new_image(Colours.GRAY)
+    draw_text(image, (9, 1), "Belsize", Colours.YELLOW)
+    draw_text(image, (44, 2), "12:34", Colours.YELLOW)
+    y = 10
+    for nickname, minutes in [("Edgware", "2"), ("Golders", "5"), ("Edgware", "11")]:
+        draw_text(image, (1, y), nickname, Colours.YELLOW)
+        draw_text(image, (60, y + 1), minutes, Colours.YELLOW)
+        y += 8
+    return image
+
+
+def benchmark_draw_text():
+    pen = Pen()
+
+    def legacy_draw_text(*args):
+        _legacy_draw_text(pen, *args)
+
+    legacy = _render_text_frame(legacy_draw_text)
+    if legacy.tobytes() != _render_text_frame(pen.draw_text).tobytes():
+        raise ValueError("The legacy and current pens disagree")
+    indexed = _render_text_frame(pen.draw_text, pen.new_image)
+    if legacy.tobytes() != indexed.convert("RGB").tobytes():
+        raise ValueError("The RGB and palette frames disagree")
+
+    legacy = _time(lambda: _render_text_frame(legacy_draw_text))
+    current = _time(lambda: _render_text_frame(pen.draw_text))
+    palette = _time(lambda: _render_text_frame(pen.draw_text, pen.new_image))
+    print(
+        f"draw_text: legacy {legacy:.1f}us, current {current:.1f}us, "
+        f"palette {palette:.1f}us per frame "
+        f"({3 * len(indexed.tobytes())}B RGB, {len(indexed.tobytes())}B palette)"
+    )
+    print(f"draw_text: {pen.cache_info()}")
+
+
+def benchmark_cold_start():
+    # Dummy values, so that the handlers can be built without any credentials
+    env = {
+        "PIXOO_URL": "http://localhost/post",
+        "TFL_APP_KEY": "benchmark",
+        "MET_OFFICE_API_KEY": "benchmark",
+        "BUCKET_NAME": "benchmark",
+        "AWS_DEFAULT_REGION": "eu-west-2",
+    }
+    env.update(os.environ)
+    for mode in MessageMode:
+        result = subprocess.run(
+            [sys.executable, "-c", COLD_START_SCRIPT, mode],
+            env=env,
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+        timings = json.loads(result.stdout)
+        print(
+            f"cold start ({mode}): import {1e3 * timings['import']:.1f}ms, "
+            f"init {1e3 * timings['init']:.1f}ms"
+        )
+
+
+def _time_and_peak(fn, repeats=20):
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return _time(fn, repeats), peak
+
+
+def _make_arrivals_response(n=2000):
+    # Shaped like a StopPoint/{id}/Arrivals response, with all the unused fields
+    arrivals = []
+    for i in range(n):
+        arrivals.append(
+            {
+                "$type": "Tfl.Api.Presentation.Entities.Prediction, Tfl.Api.Presentation.Entities",
+                "id": str(-1000000 + i),
+                "operationType": 1,
+                "vehicleId": f"{i:03}",
+                "naptanId": Stations.BELSIZE_PARK.station_id,
+                "stationName": "Belsize Park Underground Station",
+                "lineId": "northern",
+                "lineName": "Northern",
+                "platformName": "Northbound - Platform 1",
+                "direction": "inbound" if i % 2 else "outbound",
+                "bearing": "",
+                "destinationNaptanId": Stations.EDGWARE.station_id,
+                "destinationName": "Edgware Underground Station",
+                "timestamp": "2025-01-01T12:00:00.0000000Z",
+                "timeToStation": (7919 * i) % 1800,
+                "currentLocation": "Between Chalk Farm and Belsize Park",
+                "towards": "Edgware",
+                "expectedArrival": "2025-01-01T12:05:00Z",
+                "timeToLive": "2025-01-01T12:05:00Z",
+                "modeName": "tube",
+                "timing": {
+                    "$type": "Tfl.Api.Presentation.Entities.PredictionTiming, Tfl.Api.Presentation.Entities",
+                    "countdownServerAdjustment": "00:00:00",
+                    "source": "0001-01-01T00:00:00",
+                    "insert": "0001-01-01T00:00:00",
+                    "read": "2025-01-01T12:00:00.000Z",
+                    "sent": "2025-01-01T12:00:00Z",
+                    "received": "0001-01-01T00:00:00Z",
+                },
+            }
+        )
+    return json.dumps(arrivals).encode("utf-8")
+
+
+LEGACY_DUPLICATE_IDS = {"910GCLPHMJC": "910GCLPHMJ1"}
+
+
+def _legacy_filter_arrivals(data, station_id, inbound):
+    arrivals = json.loads(data.decode("utf-8"))
+    filtered_arrivals = []
+    direction = "inbound" if inbound else "outbound"
+    for a in arrivals:
+        a["naptanId"] = LEGACY_DUPLICATE_IDS.get(a["naptanId"], a["naptanId"])
+        a["destinationNaptanId"] = LEGACY_DUPLICATE_IDS.get(
+            a["destinationNaptanId"], a["destinationNaptanId"]
+        )
+        if a["direction"] == direction:
+            filtered_arrivals.append(a)
+
+    filtered_arrivals.sort(key=lambda x: x["timeToStation"])
+    return filtered_arrivals
+
+
+def benchmark_parse_arrivals():
+    data = _make_arrivals_response()
+    chunks = [data[i : i + 16384] for i in range(0, len(data), 16384)]
+    station_id = Stations.BELSIZE_PARK.station_id
+
+    def current():
+        return TFL._filter_arrivals(parse_arrivals(chunks), station_id, True)
+
+    legacy = _legacy_filter_arrivals(data, station_id, True)
+    expected = [a["timeToStation"] for a in legacy[: len(current())]]
+    if expected != [a.time_to_station for a in current()]:
+        raise ValueError("The legacy and current arrivals parsers disagree")
+
+    legacy, legacy_peak = _time_and_peak(
+        lambda: _legacy_filter_arrivals(data, station_id, True)
+    )
+    current, current_peak = _time_and_peak(current)
+    print(
+        f"parse_arrivals ({len(data) // 1024}KB): "
+        f"legacy {legacy / 1e3:.1f}ms and {legacy_peak // 1024}KB peak, "
+        f"current {current / 1e3:.1f}ms and {current_peak // 1024}KB peak"
+    )
+
+
+def _legacy_clean_cell(cell):
+    while "<" in cell:
+        start = cell.find("<")
+        end = cell.find(">", start)
+        cell = cell[:start] + cell[end + 1 :]
+    cell = cell.strip()
+    return cell
+
+
+def _legacy_parse_parkrun(html):
+    start_tbody = html.find("<tbody>")
+    start_tr = html.find("<tr", start_tbody)
+    end_tr = html.find("</tr>", start_tr)
+    first_row_html = html[start_tr:end_tr]
+    cells = first_row_html.split("<td>")[1:]
+    return Parkrun._parse_row([_legacy_clean_cell(cell) for cell in cells])
+
+
+def _legacy_parse_pond(data, day, month):
+    for row in data.split("<tr>"):
+        if f">{day!s}</td>" not in row:
+            continue
+
+        cells = row.split("</td>")
+        if len(cells) <= month:
+            continue
+
+        value = re.sub("<[^<]+?>", "", cells[month]).replace("&nbsp;", "").strip()
+        if value and value != "-":
+            return round(float(value))
+
+
+def benchmark_html_tables():
+    with open("fixtures/parkrun_runner.html", "rb") as f:
+        parkrun_page = f.read()
+    with open("fixtures/nw3weather_pond.html", "rb") as f:
+        pond_page = f.read()
+    parkrun_chunks = [
+        parkrun_page[i : i + 16384] for i in range(0, len(parkrun_page), 16384)
+    ]
+    pond_chunks = [pond_page[i : i + 16384] for i in range(0, len(pond_page), 16384)]
+    day, month = 28, 9
+
+    def current_parkrun():
+        return Parkrun._parse_row(find_row(parkrun_chunks, tbody_only=True))
+
+    def current_pond():
+        cells = find_row(pond_chunks, first_cell=str(day))
+        return round(float(cells[month]))
+
+    def legacy_parkrun():
+        return _legacy_parse_parkrun(parkrun_page.decode("utf-8"))
+
+    def legacy_pond():
+        return _legacy_parse_pond(pond_page.decode("utf-8"), day, month)
+
+    if legacy_parkrun() != current_parkrun() or legacy_pond() != current_pond():
+        raise ValueError("The legacy and current HTML parsers disagree")
+
+    for name, legacy, current in [
+        ("parkrun", legacy_parkrun, current_parkrun),
+        ("pond", legacy_pond, current_pond),
+    ]:
+        legacy = _time(legacy, 100)
+        current = _time(current, 100)
+        print(f"html ({name}): legacy {legacy:.1f}us, current {current:.1f}us")
+
+    # The scrapes stream the page, so only the chunks up to the row are downloaded
+    for name, chunks, kwargs in [
+        ("parkrun", parkrun_chunks, {"tbody_only": True}),
+        ("pond", pond_chunks, {"first_cell": str(day)}),
+    ]:
+        read = []
+        find_row((read.append(len(chunk)) or chunk for chunk in chunks), **kwargs)
+        total = sum(len(chunk) for chunk in chunks)
+        print(f"html ({name}): read {sum(read) / 1024:.0f}kB of {total / 1024:.0f}kB")
+
+
+class ReplayResponse:
+    def __init__(self, data, status=200):
+        self.data = data
+        self.status = status
+
+    def stream(self, amt):
+        for i in range(0, len(self.data), amt):
+            yield self.data[i : i + amt]
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+# Serves the recorded fixtures in place of the upstream APIs
+class ReplayPoolManager:
+    def __init__(self):
+        self.responses = {}
+
+    def request(self, method, url, **kwargs):
+        path = FIXTURES[urlparse(url).netloc]
+        if path not in self.responses:
+            with open(path, "rb") as f:
+                self.responses[path] = f.read()
+        return ReplayResponse(self.responses[path])
+
+
+# Calls the upstream APIs, and saves each response as that host's fixture
+class RecordingPoolManager:
+    def __init__(self):
+        self.pool_manager = urllib3.PoolManager()
+
+    def request(self, method, url, **kwargs):
+        kwargs.pop("preload_content", None)
+        response = self.pool_manager.request(method, url, **kwargs)
+        if response.status == 200:
+            with open(FIXTURES[urlparse(url).netloc], "wb") as f:
+                f.write(response.data)
+        return ReplayResponse(response.data, response.status)
+
+
+def record_fixtures():
+    from my_config import belsize_message, parkrun_message, weather_message
+    from weather import Weather
+
+    pool_manager = RecordingPoolManager()
+    cache = Cache(MemoryCache())
+    TFL(pool_manager=pool_manager)._request_arrivals([belsize_message.station_id])
+    weather = Weather(cache, pool_manager=pool_manager)
+    weather._update_now()
+    weather._request_forecast(weather_message.lat, weather_message.lon)
+    weather._scrape_pond_temperature(weather.now - timedelta(days=1))
+    Parkrun(cache, pool_manager=pool_manager)._get_row(
+        next(iter(parkrun_message.id_to_name))
+    )
+    print(f"Recorded {len(FIXTURES)} fixtures")
+
+
+def _measure(fn, repeats):
+    fn()
+    elapsed = _time(fn, repeats)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    # Blocks still allocated after the call, i.e. caches that grow every frame
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(ignore).compare_to(
+        before.filter_traces(ignore), "lineno"
+    )
+    kept = sum(max(stat.count_diff, 0) for stat in stats)
+    return elapsed, peak, kept
+
+
+def _make_tfl_stages(pool_manager, pen):
+    tfl = TFL(pen, pool_manager)
+    station = STATIONS[Stations.BELSIZE_PARK.station_id]
+
+    def parse():
+        response = pool_manager.request("GET", "https://api.tfl.gov.uk/")
+        arrivals = list(parse_arrivals(response.stream(16384)))
+        return tfl._filter_arrivals(arrivals, station.station_id, True)
+
+    arrivals = parse()
+
+    def make_image():
+        return tfl.make_image(
+            arrivals, station.nickname.capitalize(), station.underground
+        )
+
+    return parse, make_image
+
+
+def _make_weather_stages(pool_manager, pen):
+    from weather import POND_KEY, Weather
+
+    weather = Weather(Cache(MemoryCache()), pen, pool_manager)
+    weather._update_now()
+    yesterday = (weather.now - timedelta(days=1)).date()
+
+    def parse():
+        time_series = weather._request_forecast("51.5606", "-0.1632")
+        pond_temperature = weather._scrape_pond_temperature(yesterday)
+        return weather._to_columns(time_series), pond_temperature
+
+    forecast, pond_temperature = parse()
+    # Move the recorded forecast to this hour, so that the cache covers it
+    start = int(weather.now_timestamp) // 3600 * 3600
+    offset = start - forecast["times"][0]
+    forecast["times"] = [timestamp + offset for timestamp in forecast["times"]]
+    weather.cache.save(forecast, "forecast_lat=51.5606_lon=-0.1632.json")
+    weather.cache.save(
+        {"date": yesterday.isoformat(), "temperature": pond_temperature or -99},
+        POND_KEY,
+    )
+
+    def make_image():
+        return weather.make_image("51.5606", "-0.1632")
+
+    return parse, make_image
+
+
+def _make_parkrun_stages(pool_manager, pen):
+    parkrun = Parkrun(Cache(MemoryCache()), pen, pool_manager)
+    id_to_name = {"1": "Archie L", "2": "Patrick L", "3": "Sean L"}
+
+    def parse():
+        return parkrun._scrape("1")
+
+    # Post the recorded result as today's, for every runner
+    stats = parse()
+    stats["date"] = datetime.now().strftime("%d/%m/%Y")
+    results = {}
+    for i, id_ in enumerate(id_to_name):
+        results[id_] = {**stats, "time": stats["time"] + 17 * i}
+    parkrun.cache.save(results, "results.json")
+
+    def make_image():
+        return parkrun.make_image(id_to_name)
+
+    return parse, make_image
+
+
+def benchmark_render(profile=False, repeats=200):
+    # Dummy keys, the fixtures are replayed so nothing is sent upstream
+    os.environ.setdefault("TFL_APP_KEY", "benchmark")
+    os.environ.setdefault("MET_OFFICE_API_KEY", "benchmark")
+    pool_manager = ReplayPoolManager()
+    pen = Pen()
+
+    for name, make_stages in [
+        ("tfl", _make_tfl_stages),
+        ("weather", _make_weather_stages),
+        ("parkrun", _make_parkrun_stages),
+    ]:
+        parse, make_image = make_stages(pool_manager, pen)
+        image = make_image()
+        for stage, fn in [
+            ("parse", parse),
+            ("make_image", make_image),
+            ("encode_image", lambda: Pixoo.encode_image(image)),
+        ]:
+            elapsed, peak, kept = _measure(fn, repeats)
+            print(
+                f"render ({name}) {stage}: {elapsed:.1f}us, "
+                f"{peak / 1024:.1f}KB peak, {kept} blocks kept"
+            )
+
+        if profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            for _ in range(repeats):
+                Pixoo.encode_image(make_image())
+            profiler.disable()
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+
+
+def benchmark_backgrounds():
+    os.environ.setdefault("TFL_APP_KEY", "benchmark")
+    os.environ.setdefault("MET_OFFICE_API_KEY", "benchmark")
+    from weather import Weather
+
+    pool_manager = ReplayPoolManager()
+    pen = Pen()
+    cache = Cache(MemoryCache())
+
+    tfl = TFL(pen, pool_manager)
+    response = pool_manager.request("GET", "https://api.tfl.gov.uk/")
+    arrivals = TFL._filter_arrivals(
+        list(parse_arrivals(response.stream(16384))),
+        Stations.BELSIZE_PARK.station_id,
+        True,
+    )
+
+    weather = Weather(cache, pen, pool_manager)
+    weather._update_now()
+    readings = {
+        "screenTemperature": 12.3,
+        "pondTemperature": 11,
+        "probOfPrecipitation": 40,
+        "screenRelativeHumidity": 81,
+    }
+
+    parkrun = Parkrun(cache, pen, pool_manager)
+    parkrun._update_now()
+    runners = [
+        Runner(name=name, id_=str(i), time=1200 + 17 * i)
+        for i, name in enumerate(["Archie L", "Patrick L", "Sean L"])
+    ]
+
+    for name, render, clear in [
+        (
+            "tfl",
+            lambda: tfl.make_image(arrivals, "Belsize", True),
+            tfl._get_background.cache_clear,
+        ),
+        (
+            "weather",
+            lambda: weather._render(readings),
+            lambda: weather.__dict__.pop("background", None),
+        ),
+        (
+            "parkrun",
+            lambda: parkrun._render(runners),
+            lambda: parkrun.__dict__.pop("background", None),
+        ),
+    ]:
+
+        def uncached():
+            clear()
+            return render()
+
+        if uncached().tobytes() != render().tobytes():
+            raise ValueError("The cached and uncached backgrounds disagree")
+
+        uncached = _time(uncached)
+        cached = _time(render)
+        print(
+            f"background ({name}): redrawn {uncached:.1f}us, "
+            f"cached {cached:.1f}us per frame"
+        )
+
+
+def benchmark_frames():
+    os.environ.setdefault("TFL_APP_KEY", "benchmark")
+    os.environ.setdefault("MET_OFFICE_API_KEY", "benchmark")
+    pool_manager = ReplayPoolManager()
+    pen = Pen()
+
+    for name, make_stages in [
+        ("tfl", _make_tfl_stages),
+        ("weather", _make_weather_stages),
+        ("parkrun", _make_parkrun_stages),
+    ]:
+        _, make_image = make_stages(pool_manager, pen)
+        image = make_image()
+        # An animated message, with the colon of the clock hidden
+        frames = [image, image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)]
+
+        payload = Pixoo.make_payload(frames, speed=1000)
+        blob = pack_frames(frames, speed=1000)
+        unpacked = Pixoo.make_payload_from_blob(blob)
+        if Pixoo._hash_payload(unpacked) != Pixoo._hash_payload(payload):
+            raise ValueError("The packed frames don't match the originals")
+
+        json_size = len(json.dumps(payload))
+        queued_size = len(base64.b64encode(blob))
+        pack = _time(lambda: pack_frames(frames, speed=1000))
+        from_images = _time(lambda: Pixoo.make_payload(frames, speed=1000))
+        from_blob = _time(lambda: Pixoo.make_payload_from_blob(blob))
+        print(
+            f"frames ({name}): JSON {json_size / 1024:.1f}KB, "
+            f"packed {len(blob) / 1024:.1f}KB ({queued_size / 1024:.1f}KB queued), "
+            f"pack {pack:.1f}us, payload from images {from_images:.1f}us, "
+            f"from packed {from_blob:.1f}us"
+        )
+
+
+def benchmark_stations():
+    # The committed file, and one with thousands of stations, i.e. all of TfL's
+    rows = _make_synthetic_rows(SYNTHETIC_STATIONS)
+    station_id = next(iter(rows))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "stations.tsv")
+        _write_rows(path, rows)
+        for name, path, station_id in [
+            ("committed", STATIONS_PATH, Stations.BELSIZE_PARK.station_id),
+            (f"{len(rows)} stations", path, station_id),
+        ]:
+            create = _time(lambda: StationRegistry(path), 10000)
+            load = _time(lambda: StationRegistry(path)[station_id], 20)
+            registry = StationRegistry(path)
+            registry[station_id]
+            lookup = _time(lambda: registry[station_id], 100000)
+            print(
+                f"stations ({name}): create {create:.2f}us, "
+                f"first lookup {load / 1e3:.2f}ms, lookup {1e3 * lookup:.0f}ns"
+            )
+
+
+def benchmark_tracing():
+    lines = []
+    tracer = Tracer(sink=lines.append)
+
+    def untraced():
+        pass
+
+    def traced():
+        with tracer.span("render"):
+            pass
+
+    untraced = _time(untraced, 100000)
+    disabled = _time(traced, 100000)
+    tracer.format = "json"
+    enabled = _time(traced, 100000)
+    tracer.flush(mode="benchmark")
+    print(
+        f"tracing: untraced {1e3 * untraced:.0f}ns, disabled {1e3 * disabled:.0f}ns, "
+        f"enabled {1e3 * enabled:.0f}ns per span, {len(lines)} line logged"
+    )
+
+
+BENCHMARKS = {
+    "encode_image": benchmark_encode_image,
+    "draw_text": benchmark_draw_text,
+    "parse_arrivals": benchmark_parse_arrivals,
+    "html_tables": benchmark_html_tables,
+    "render": benchmark_render,
+    "backgrounds": benchmark_backgrounds,
+    "frames": benchmark_frames,
+    "tracing": benchmark_tracing,
+    "stations": benchmark_stations,
+    "cold_start": benchmark_cold_start,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmarks", nargs="*", help=f"Any of {', '.join(BENCHMARKS)}, or record"
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="Print cProfile stats for render"
+    )
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS and name != "record":
+            parser.error(f'Benchmark "{name}" is not supported')
+
+    if "record" in args.benchmarks:
+        record_fixtures()
+        return
+
+    for name in args.benchmarks or BENCHMARKS:
+        if name == "render":
+            benchmark_render(profile=args.profile)
+        else:
+            BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+
+from tracing import span
+
+
+class NotModified(Exception):
+    pass
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    not_modified: int = 0
+    backend_calls: int = 0
+    backend_seconds: float = 0.0
+
+
+@dataclass
+class CacheEntry:
+    results: object
+    last_updated: float | None
+    etag: str | None
+    checked: float
+
+
+class MemoryCache:
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, key, etag=None):
+        if key not in self.objects:
+            return {}, None, None
+
+        body, last_updated, object_etag = self.objects[key]
+        if etag is not None and etag == object_etag:
+            raise NotModified(key)
+
+        return json.loads(body), last_updated, object_etag
+
+    def save(self, results, key):
+        body = json.dumps(results)
+        etag = hashlib.md5(body.encode("utf-8")).hexdigest()
+        self.objects[key] = (body, time.time(), etag)
+        return etag
+
+
+class FileCache:
+    def __init__(self, directory=None):
+        self.directory = directory or os.environ.get("CACHE_DIR", ".cache")
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def _etag(stat):
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def get(self, key, etag=None):
+        path = os.path.join(self.directory, key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return {}, None, None
+
+        file_etag = self._etag(stat)
+        if etag is not None and etag == file_etag:
+            raise NotModified(key)
+
+        with open(path, encoding="utf-8") as f:
+            results = json.load(f)
+        return results, stat.st_mtime, file_etag
+
+    def save(self, results, key):
+        path = os.path.join(self.directory, key)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(results, f)
+        return self._etag(os.stat(path))
+
+
+class Cache:
+    def __init__(self, backend, ttl: float = 60, maxsize: int = 32):
+        self.backend = backend
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.stats = CacheStats()
+        # Requests run concurrently, so guard the entries and the stats
+        self.lock = threading.Lock()
+
+    def _store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def _fetch(self, key, etag):
+        start = time.perf_counter()
+        try:
+            with span("cache_get"):
+                return self.backend.get(key, etag=etag)
+        finally:
+            with self.lock:
+                self.stats.backend_calls += 1
+                self.stats.backend_seconds += time.perf_counter() - start
+
+    def get(self, key, ttl: float | None = None):
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry.checked < ttl:
+                self.stats.hits += 1
+                self.entries.move_to_end(key)
+                return copy.deepcopy(entry.results), entry.last_updated
+
+        try:
+            results, last_updated, etag = self._fetch(
+                key, None if entry is None else entry.etag
+            )
+        except NotModified:
+            with self.lock:
+                self.stats.not_modified += 1
+                entry.checked = now
+                self._store(key, entry)
+            return copy.deepcopy(entry.results), entry.last_updated
+
+        with self.lock:
+            self.stats.misses += 1
+            self._store(key, CacheEntry(results, last_updated, etag, now))
+        return copy.deepcopy(results), last_updated
+
+    def save(self, results, key):
+        with span("cache_save"):
+            etag = self.backend.save(results, key)
+        now = time.time()
+        with self.lock:
+            self._store(key, CacheEntry(copy.deepcopy(results), now, etag, now))
+
+    def get_stats(self):
+        with self.lock:
+            return asdict(self.stats)
+
+
+def make_cache(backend=None, **kwargs):
+    backend = backend or os.environ.get("CACHE_BACKEND", "s3")
+    if backend == "s3":
+        # boto3 is slow to import, so only import it when it's used
+        from s3_cache import S3Cache
+
+        return Cache(S3Cache(), **kwargs)
+
+    if backend == "file":
+        return Cache(FileCache(), **kwargs)
+
+    if backend == "memory":
+        return Cache(MemoryCache(), **kwargs)
+
+    raise ValueError(f'Cache backend "{backend}" is not supported')
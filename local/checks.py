@@ -0,0 +1,298 @@
+import argparse
+import os
+import random
+import tempfile
+
+from frames import PALETTE, RAW, pack_frames, unpack_frames
+from html_table import find_row
+from pen import Colours, Pen
+from PIL import Image
+from pixoo import Pixoo
+from stations import (
+    COLUMNS,
+    STATIONS_PATH,
+    StationRegistry,
+    _merge_stop_points,
+    _read_rows,
+    _write_rows,
+)
+
+# Correctness checks that are quick enough to run on every change,
+# the benchmarks only time the code
+
+
+# Pages, find_row's arguments and the row that it should find
+FIND_ROW_CASES = [
+    # Rows and cells that aren't closed
+    (b"<table><tr><td>1<td>a<tr><td>2<td>b</table>", {"first_cell": "2"}, ["2", "b"]),
+    (b"<table><tr><td>1<td>a<tr><td>2<td>b", {"first_cell": "2"}, ["2", "b"]),
+    # Upper-case tags
+    (
+        b"<TABLE><THEAD><TR><TH>Day</TH></TR></THEAD>"
+        b"<TBODY><TR><TD>1</TD><TD>x</TD></TR></TBODY></TABLE>",
+        {"tbody_only": True},
+        ["1", "x"],
+    ),
+    (b"<TABLE><TR><TH>Day<TR><TD>1<TD>x</TABLE>", {"first_cell": "1"}, ["1", "x"]),
+    # Entities, including one that spells part of the first cell
+    (
+        b"<tr><td>&nbsp;3&nbsp;</td><td>A &amp; B</td></tr>",
+        {"first_cell": "3"},
+        ["3", "A & B"],
+    ),
+    (b"<tr><td>&#50;8</td><td>y</td></tr>", {"first_cell": "28"}, ["28", "y"]),
+    # A first cell wrapped in tags, and the first cell's text in a later cell
+    (b"<tr><td><b>28</b></td><td>z</td></tr>", {"first_cell": "28"}, ["28", "z"]),
+    (
+        b"<tr><td>1</td><td>28</td></tr><tr><td title='28'>2</td></tr>"
+        b"<tr><td>28</td><td>ok</td></tr>",
+        {"first_cell": "28"},
+        ["28", "ok"],
+    ),
+    # Tags that start like a row, and the first row without any cells
+    (
+        b"<table><tr><td>1<track src=x></td><td>a</td></tr></table>",
+        {"first_cell": "1"},
+        ["1", "a"],
+    ),
+    (b"<tbody><tr></tr><tr><td>1</td></tr>", {"tbody_only": True}, ["1"]),
+    # Rows that aren't there
+    (b"<tr><td>1</td></tr>", {"first_cell": "2"}, None),
+    (b"<table><tr><td>1</td></tr></table>", {"tbody_only": True}, None),
+]
+
+
+def _check_find_row(page, kwargs, expected, max_chunk_size=None):
+    # Every chunk size, so that the rows, cells, tags and entities are split
+    for size in range(1, (max_chunk_size or len(page)) + 1):
+        chunks = (page[i : i + size] for i in range(0, len(page), size))
+        cells = find_row(chunks, **kwargs)
+        if cells != expected:
+            raise ValueError(
+                f"find_row({page[:40]!r}..., {kwargs}) in {size} byte chunks "
+                f"returned {cells}, not {expected}"
+            )
+
+
+def check_html_tables():
+    for page, kwargs, expected in FIND_ROW_CASES:
+        _check_find_row(page, kwargs, expected)
+
+    # The recorded pages, with tags split at every chunk boundary
+    with open("fixtures/parkrun_runner.html", "rb") as f:
+        parkrun_page = f.read()
+    with open("fixtures/nw3weather_pond.html", "rb") as f:
+        pond_page = f.read()
+    # The row is in the first few kB of the parkrun page, so bigger chunks are the same
+    _check_find_row(
+        parkrun_page,
+        {"tbody_only": True},
+        find_row([parkrun_page], tbody_only=True),
+        16384,
+    )
+    _check_find_row(
+        pond_page, {"first_cell": "28"}, find_row([pond_page], first_cell="28")
+    )
+
+
+def _check_round_trip(name, frames, kind, speed=1000):
+    blob = pack_frames(frames, speed=speed)
+    if blob[3] != kind:
+        raise ValueError(f"The {name} frames were packed as the wrong kind")
+
+    buffer, count, unpacked_speed = unpack_frames(blob)
+    rgb = b"".join(frame.convert("RGB").tobytes() for frame in frames)
+    if bytes(buffer) != rgb or count != len(frames) or unpacked_speed != speed:
+        raise ValueError(f"The unpacked {name} frames don't match the originals")
+
+    # The consumer posts the same payload, whether or not the frames were packed
+    payload = Pixoo.make_payload_from_blob(blob)
+    if Pixoo._hash_payload(payload) != Pixoo._hash_payload(
+        Pixoo.make_payload(frames, speed=speed)
+    ):
+        raise ValueError(f"The payload of the packed {name} frames is different")
+
+
+def _check_raises(name, fn):
+    try:
+        fn()
+    except ValueError:
+        return
+    raise ValueError(f"{name} didn't raise a ValueError")
+
+
+def _make_colours_frame(n):
+    # A frame with n colours, in stripes
+    frame = Image.new("RGB", (64, 64))
+    for i in range(n):
+        frame.paste((i * 7 % 256, i * 13 % 256, i * 29 % 256), (0, i, 64, i + 1))
+    return frame
+
+
+def check_frames():
+    # Frames with too many colours for a palette are packed as raw RGB
+    noise = Image.frombytes("RGB", (64, 64), random.Random(0).randbytes(64 * 64 * 3))
+    _check_round_trip("noise", [noise], RAW)
+    _check_round_trip("17 colour", [_make_colours_frame(17)], RAW)
+
+    # Frames drawn in palette indices, and RGB frames with a few colours
+    pen = Pen()
+    indexed = pen.new_image(Colours.GRAY)
+    pen.draw_text(indexed, (1, 1), "Belsize 12:34", Colours.YELLOW)
+    flipped = indexed.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    _check_round_trip("P mode", [indexed], PALETTE)
+    _check_round_trip("P mode animation", [indexed, flipped], PALETTE, speed=0)
+    _check_round_trip("16 colour", [_make_colours_frame(16)], PALETTE)
+    _check_round_trip("1 colour", [Image.new("RGB", (64, 64))], PALETTE)
+
+    # A mix of both, where the animation has too many colours in total
+    _check_round_trip("mixed", [indexed, noise], RAW)
+
+    _check_raises("No frames", lambda: pack_frames([]))
+    _check_raises("256 frames", lambda: pack_frames([noise] * 256))
+    _check_raises("A 32x32 frame", lambda: pack_frames([Image.new("RGB", (32, 32))]))
+    blob = pack_frames([noise])
+    _check_raises("Another version", lambda: unpack_frames(b"PX\x02" + blob[3:]))
+    _check_raises("A truncated blob", lambda: unpack_frames(blob[:-1]))
+
+
+# The fields of TfL's StopPoint/Mode response that the station file is built from
+STOP_POINTS = [
+    # A hand-tuned station, and another listing of one
+    {
+        "naptanId": "940GZZLUBZP",
+        "commonName": "Belsize Park Underground Station",
+        "stopType": "NaptanMetroStation",
+        "modes": ["tube"],
+    },
+    {
+        "naptanId": "910GCLPHMJC",
+        "commonName": "Clapham Junction Rail Station",
+        "stopType": "NaptanRailStation",
+        "modes": ["overground"],
+    },
+    # New stations, with names longer than a nickname, and a name in one word
+    {
+        "naptanId": "940GZZLUWHW",
+        "commonName": "Westminsterbridgeroad Underground Station",
+        "stopType": "NaptanMetroStation",
+        "modes": ["tube"],
+    },
+    {
+        "naptanId": "910GKENR",
+        "commonName": "Kensal Rise Rail Station",
+        "stopType": "NaptanRailStation",
+        "modes": ["overground"],
+    },
+    {
+        "naptanId": "940GZZLUHRC",
+        "commonName": "Heathrow Terminals 2 & 3 Underground Station",
+        "stopType": "NaptanMetroStation",
+        "modes": ["tube"],
+    },
+    {
+        "naptanId": "940GZZDLCGT",
+        "commonName": "Canning Town DLR Station",
+        "stopType": "NaptanMetroStation",
+        "modes": ["dlr"],
+    },
+    {
+        "naptanId": "910GPADTLL",
+        "commonName": "Paddington (Elizabeth line) Rail Station",
+        "stopType": "NaptanRailStation",
+        "modes": ["elizabeth-line"],
+    },
+    # Stops that trains don't stop at
+    {
+        "naptanId": "940GZZLUBZP1",
+        "commonName": "Belsize Park Underground Station",
+        "stopType": "NaptanMetroEntrance",
+        "modes": ["tube"],
+    },
+]
+NEW_ROWS = {
+    "940GZZLUWHW": ["940GZZLUWHW", "westminster", "", "1", "", "", ""],
+    "940GZZLUHRC": ["940GZZLUHRC", "heathrow", "", "1", "", "", ""],
+    "940GZZDLCGT": ["940GZZDLCGT", "canning", "", "0", "", "", ""],
+    "910GPADTLL": ["910GPADTLL", "paddington", "", "0", "", "", ""],
+}
+# Rows added to the station file, i.e. several times the size of TfL's network
+SYNTHETIC_STATIONS = 5000
+
+
+def _make_synthetic_rows(n):
+    rows = {}
+    for i in range(n):
+        station_id = f"940GZZSYN{i:05d}"
+        aliases = f"HUBSYN{i:05d}" if i % 10 == 0 else ""
+        exceptions = f"940GZZSYN{(i + 1) % n:05d}" if i % 50 == 0 else ""
+        rows[station_id] = [
+            station_id,
+            f"syn {i}",
+            "",
+            str(i % 2),
+            aliases,
+            exceptions,
+            "",
+        ]
+    return rows
+
+
+def check_stations():
+    known_rows = _read_rows(STATIONS_PATH)
+    rows = _merge_stop_points(STOP_POINTS, known_rows)
+    if rows != {**known_rows, **NEW_ROWS}:
+        raise ValueError(f"The merged stations are {rows}")
+
+    synthetic_rows = _make_synthetic_rows(SYNTHETIC_STATIONS)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "stations.tsv")
+        _write_rows(path, {**rows, **synthetic_rows})
+        with open(path, encoding="utf-8") as f:
+            if next(f).rstrip("\n").split("\t") != COLUMNS:
+                raise ValueError("The station file has the wrong columns")
+        registry = StationRegistry(path)
+
+        if len(registry) != len(rows) + SYNTHETIC_STATIONS:
+            raise ValueError(f"Loaded {len(registry)} stations")
+        for station_id, row in {**rows, **synthetic_rows}.items():
+            station = registry[station_id]
+            if [station.nickname, station.code, str(int(station.underground))] != [
+                row[1],
+                row[2],
+                row[3],
+            ]:
+                raise ValueError(f"{station_id} was loaded as {station}")
+            for alias in filter(None, row[4].split(",")):
+                if registry.canonical_id(alias) != station_id or alias not in registry:
+                    raise ValueError(f"The alias {alias} isn't {station_id}")
+            for i, direction in enumerate(["inbound", "outbound"]):
+                expected = frozenset(filter(None, row[5 + i].split(",")))
+                if registry.direction_exceptions(station_id, direction) != expected:
+                    raise ValueError(f"The {direction} exceptions of {station_id}")
+        if "940GZZLUBZP1" in registry or registry.get("940GZZLUBZP1") is not None:
+            raise ValueError("An entrance was loaded as a station")
+
+
+CHECKS = {
+    "html_tables": check_html_tables,
+    "frames": check_frames,
+    "stations": check_stations,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checks", nargs="*", help=f"Any of {', '.join(CHECKS)}")
+    args = parser.parse_args()
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error(f'Check "{name}" is not supported')
+
+    for name in args.checks or CHECKS:
+        CHECKS[name]()
+        print(f"{name}: ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 import json
-from dataclasses import asdict, dataclass
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, time
 from enum import IntEnum, StrEnum, auto
 
+# The device that's set by PIXOO_URL, when PIXOO_URLS isn't used
+DEFAULT_DEVICE = "default"
+
 
 class Weekday(IntEnum):
     MONDAY = 0
@@ -18,13 +22,54 @@ class MessageMode(StrEnum):
     WEATHER = auto()
 
 
+# Seconds between redraws of a message that stays on screen
+REFRESH_SECONDS = {
+    MessageMode.TFL: 30,
+    MessageMode.PARKRUN: 60,
+    MessageMode.WEATHER: 60,
+}
+
+
+@dataclass(frozen=True)
+class Window:
+    # Local times, a window that ends before it starts runs past midnight,
+    # and one that ends when it starts runs all day
+    start: time = time(0)
+    end: time = time(0)
+    weekdays: tuple[Weekday, ...] | None = None
+
+    def contains(self, now: datetime):
+        if self.weekdays is not None and now.weekday() not in self.weekdays:
+            return False
+
+        now_time = now.time()
+        if self.start < self.end:
+            return self.start <= now_time < self.end
+        return now_time >= self.start or now_time < self.end
+
+
 @dataclass(frozen=True, kw_only=True)
 class Message:
     mode: MessageMode
     weekday: Weekday | None = None
+    # The message is only shown during these windows, or all the time
+    windows: tuple[Window, ...] = ()
+    # Seconds between redraws when the message stays on screen, see REFRESH_SECONDS
+    refresh_seconds: int | None = None
+    animate: bool = False
 
-    def to_message_body(self):
-        d = {k: v for k, v in asdict(self).items() if k not in {"weekday"}}
+    def to_message_body(
+        self, display_at: float | None = None, devices: list[str] | None = None
+    ):
+        d = {
+            k: v
+            for k, v in asdict(self).items()
+            if k not in {"weekday", "windows", "refresh_seconds"}
+        }
+        if display_at is not None:
+            d["display_at"] = display_at
+        if devices is not None:
+            d["devices"] = devices
         return json.dumps(d)
 
 
@@ -48,7 +93,79 @@ class WeatherMessage(Message):
     lon: str
 
 
+@dataclass(frozen=True)
+class Device:
+    name: str
+    # The messages that this device shows, or all of the config's messages
+    messages: list[Message] | None = None
+
+
 @dataclass(frozen=True)
 class Config:
     messages: list[Message]
     messages_per_minute: int = 6
+    # Without any devices, every device shows every message
+    devices: list[Device] = field(default_factory=list)
+
+    def get_messages(self):
+        messages = list(self.messages)
+        for device in self.devices:
+            for message in device.messages or []:
+                if message not in messages:
+                    messages.append(message)
+        return messages
+
+
+def filter_messages(messages):
+    filtered_messages = []
+
+    # The same local time for the day and the windows, so they agree around midnight
+    now = datetime.now()
+    for message in messages:
+        if message.weekday is not None and message.weekday != now.weekday():
+            continue
+
+        if message.windows and not any(
+            window.contains(now) for window in message.windows
+        ):
+            continue
+
+        filtered_messages.append(message)
+    return filtered_messages
+
+
+def rotate_evenly(messages, slots: int):
+    return [messages[i % len(messages)] for i in range(slots)]
+
+
+def plan_minute(config: Config, rotate=rotate_evenly):
+    # The messages for each slot of the minute, and the devices that show each one,
+    # so that a message shown on several devices at once is only rendered once
+    device_messages = []
+    for device in config.devices or [Device(DEFAULT_DEVICE)]:
+        messages = device.messages if device.messages is not None else config.messages
+        messages = filter_messages(messages)
+        if messages:
+            messages = rotate(messages, config.messages_per_minute)
+        device_messages.append((device.name, messages))
+
+    slots = []
+    for i in range(config.messages_per_minute):
+        targets = []
+        for name, messages in device_messages:
+            if not messages:
+                continue
+
+            message = messages[i]
+            for target_message, names in targets:
+                if target_message == message:
+                    names.append(name)
+                    break
+            else:
+                targets.append((message, [name]))
+        slots.append(targets)
+
+    # Without any devices in the config, messages go to every device
+    if not config.devices:
+        return [[(message, None) for message, _ in targets] for targets in slots]
+    return slots
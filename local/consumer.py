@@ -1,56 +1,229 @@
+import base64
 import json
+import threading
 import time
+from functools import cached_property, partial
 
+import urllib3
+from cache import make_cache
 from config import MessageMode
-from weather import Weather
-from parkrun import Parkrun
-from pixoo import Pixoo
-from s3_cache import S3Cache
-from tfl import ID_TO_STATION, TFL, Stations
+from fetch import MAX_WORKERS, gather
+from frames import pack_frames
+from pen import Pen
+from pixoo import Pixoo, get_device_urls
+from stations import STATIONS, Stations
+from tfl import TFL
+from tracing import span, tracer
 
-pixoo = Pixoo()
-cache = S3Cache()
-tfl = TFL()
-parkrun = Parkrun(cache)
-weather = Weather(cache)
+# Milliseconds per frame of an animation (i.e. the blinking clock)
+FRAME_SPEED = 1000
 
+# Seconds that a rendered frame is reused for, i.e. by devices showing it in later slots
+RENDER_TTL = 15
 
-def lambda_handler(event, context):
-    record = event["Records"][0]
-    body = json.loads(record["body"])
+
+# Each mode's handler is built the first time that mode is seen,
+# so a Lambda only pays for the assets and clients that it uses
+class Handlers:
+    def __init__(self):
+        self.handlers = {}
+        self.renders = {}
+        self.lock = threading.Lock()
+
+    @cached_property
+    def pool_manager(self):
+        return urllib3.PoolManager(maxsize=MAX_WORKERS)
+
+    @cached_property
+    def pen(self):
+        return Pen()
+
+    @cached_property
+    def cache(self):
+        return make_cache()
+
+    @cached_property
+    def devices(self):
+        # Containers push to the same devices concurrently, so the last frame and
+        # breaker state of each device are shared through the cache
+        return {
+            name: Pixoo(self.pool_manager, self.cache, url, name)
+            for name, url in get_device_urls().items()
+        }
+
+    def _make_handler(self, mode):
+        if mode == MessageMode.TFL:
+            return TFL(self.pen, self.pool_manager)
+
+        if mode == MessageMode.PARKRUN:
+            from parkrun import Parkrun
+
+            return Parkrun(self.cache, self.pen, self.pool_manager)
+
+        if mode == MessageMode.WEATHER:
+            from weather import Weather
+
+            return Weather(self.cache, self.pen, self.pool_manager)
+
+        raise ValueError(f'Mode "{mode}" is not supported')
+
+    def get(self, mode):
+        if mode not in self.handlers:
+            self.handlers[mode] = self._make_handler(mode)
+        return self.handlers[mode]
+
+
+handlers = Handlers()
+
+
+def make_frames(body):
     mode = body["mode"]
+    animate = body.get("animate", False)
+    handler = handlers.get(mode)
 
     if mode == MessageMode.TFL:
-        station = ID_TO_STATION[body["station_id"]]
+        station = STATIONS[body["station_id"]]
         inbound = body["inbound"]
 
-        image = tfl.make_image(
-            arrivals=tfl.get_and_filter_arrivals(station.station_id, inbound),
+        return handler.make_frames(
+            arrivals=handler.get_and_filter_arrivals(station.station_id, inbound),
             header_text=station.nickname.capitalize(),
             underground=station.underground,
+            animate=animate,
         )
-    elif mode == MessageMode.PARKRUN:
+
+    if mode == MessageMode.PARKRUN:
         id_to_name = body["id_to_name"]
-        image = parkrun.make_image(id_to_name)
-    elif mode == MessageMode.WEATHER:
+        return handler.make_frames(id_to_name, animate=animate)
+
+    if mode == MessageMode.WEATHER:
         lat = body["lat"]
         lon = body["lon"]
-        image = weather.make_image(lat, lon)
+        return handler.make_frames(lat, lon, animate=animate)
+
+
+def _render(body, kind, render):
+    # Frames are shared between devices, as long as the clock on them is still right
+    key = json.dumps(
+        {k: v for k, v in body.items() if k not in {"display_at", "devices", "frames"}},
+        sort_keys=True,
+    )
+    now = time.time()
+    with handlers.lock:
+        rendered = handlers.renders.get((kind, key))
+    if rendered is not None:
+        rendered_at, value = rendered
+        if now - rendered_at < RENDER_TTL and rendered_at // 60 == now // 60:
+            return value
+
+    value = render(make_frames(body))
+    with handlers.lock:
+        handlers.renders[(kind, key)] = (now, value)
+    return value
+
+
+def make_payload(body):
+    return _render(body, "payload", partial(Pixoo.make_payload, speed=FRAME_SPEED))
+
+
+def make_blob(body):
+    # The packed frames, for the producer to render a message ahead
+    return _render(body, "blob", partial(pack_frames, speed=FRAME_SPEED))
+
+
+def send(payload, device_names=None):
+    devices = handlers.devices
+    if device_names is None:
+        device_names = list(devices)
+
+    for name in device_names:
+        if name not in devices:
+            print(f'Device "{name}" is not set in PIXOO_URLS')
+    device_names = [name for name in device_names if name in devices]
+
+    # Each device has its own connection, so a slow device doesn't hold up the rest
+    results = gather(*[partial(devices[name].send, payload) for name in device_names])
+    return dict(zip(device_names, results))
+
+
+def prefetch(bodies):
+    # Frames that were rendered ahead don't need any data
+    bodies = [body for body in bodies if "frames" not in body]
+
+    # Fetch every station with a single request
+    station_ids = [
+        body["station_id"] for body in bodies if body["mode"] == MessageMode.TFL
+    ]
+    if len(set(station_ids)) > 1:
+        handlers.get(MessageMode.TFL).prefetch(station_ids)
+
+    # Refresh the forecasts for every location at once
+    locations = [
+        (body["lat"], body["lon"])
+        for body in bodies
+        if body["mode"] == MessageMode.WEATHER
+    ]
+    if len(set(locations)) > 1:
+        handlers.get(MessageMode.WEATHER).prefetch(locations)
+
+
+def _process(body):
+    # The producer may have rendered the frame already, so it only needs posting
+    if "frames" in body:
+        payload = Pixoo.make_payload_from_blob(base64.b64decode(body["frames"]))
     else:
-        raise ValueError(f'Mode "{mode}" is not supported')
+        payload = make_payload(body)
 
-    payload = {
-        "Command": "Draw/SendHttpGif",
-        "PicNum": 1,
-        "PicWidth": 64,
-        "PicOffset": 0,
-        "PicID": int(time.time()),
-        "PicSpeed": 0,
-        "PicData": pixoo.encode_image(image),
-    }
-    result = pixoo.post(payload)
+    # Messages can arrive early when SQS batches them, so wait until they're due
+    delay = body.get("display_at", 0) - time.time()
+    if delay > 0:
+        with span("wait"):
+            time.sleep(delay)
+
+    return send(payload, body.get("devices"))
+
+
+def _is_replaced(messages, i):
+    # A later message that's already due replaces this one, on the devices it shows on
+    devices = set(messages[i][2].get("devices") or handlers.devices)
+    for display_at, _, body in messages[i + 1 :]:
+        if display_at > time.time():
+            return False
+        if devices <= set(body.get("devices") or handlers.devices):
+            return True
+    return False
+
+
+def lambda_handler(event, context):
+    messages = []
+    for record in event["Records"]:
+        body = json.loads(record["body"])
+        messages.append((body.get("display_at", 0), record["messageId"], body))
+    messages.sort(key=lambda message: message[0])
+
+    prefetch([body for _, _, body in messages])
+    tracer.flush(mode="prefetch")
+
+    failures = []
+    for i, (display_at, message_id, body) in enumerate(messages):
+        # Skip messages that would be replaced immediately by a later message
+        if _is_replaced(messages, i):
+            continue
+
+        try:
+            result = _process(body)
+        except Exception as e:
+            print(f'Failed to process message "{message_id}": {e}')
+            failures.append({"itemIdentifier": message_id})
+            continue
+        finally:
+            tracer.flush(mode=body["mode"])
+
+        print(result)
 
-    return result
+    for name, pixoo in handlers.devices.items():
+        print(f'Pixoo "{name}" stats: {pixoo.get_stats()}')
+    return {"batchItemFailures": failures}
 
 
 def main():
@@ -59,7 +232,7 @@ def main():
         "station_id": Stations.HAMPSTEAD_HEATH.station_id,
         "inbound": True,
     }
-    event = {"Records": [{"body": json.dumps(body)}]}
+    event = {"Records": [{"messageId": "main", "body": json.dumps(body)}]}
     context = None
     result = lambda_handler(event, context)
     print(result)
@@ -0,0 +1,102 @@
+import json
+import time
+from collections import deque
+
+from config import Config, MessageMode, plan_minute
+from consumer import handlers, make_payload, send
+from tracing import tracer
+
+# Seconds of headroom on top of the slowest recent render
+RENDER_MARGIN = 0.5
+
+
+class Daemon:
+    def __init__(self, config: Config, history: int = 60):
+        self.config = config
+        self.station_ids = [
+            message.station_id
+            for message in config.get_messages()
+            if message.mode == MessageMode.TFL
+        ]
+        self.render_latencies = deque(maxlen=history)
+        self.jitters = deque(maxlen=history)
+
+    def _slots(self):
+        minute = time.time() // 60 * 60
+        while True:
+            slots = plan_minute(self.config)
+            if any(slots):
+                for i, targets in enumerate(slots):
+                    slot_time = minute + 60 * i / self.config.messages_per_minute
+                    if targets:
+                        yield slot_time, targets
+            else:
+                # Nothing to show right now, so check again next minute
+                self._sleep_until(minute + 60)
+            minute += 60
+
+    def _lead(self):
+        # Start rendering early enough that the frame is ready for its slot
+        if not self.render_latencies:
+            return RENDER_MARGIN
+        return max(self.render_latencies) + RENDER_MARGIN
+
+    @staticmethod
+    def _sleep_until(timestamp):
+        delay = timestamp - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def run_slot(self, slot_time, targets):
+        self._sleep_until(slot_time - self._lead())
+
+        # Devices showing different messages in the same slot are all rendered first
+        start = time.perf_counter()
+        if any(message.mode == MessageMode.TFL for message, _ in targets):
+            # Fetch every station with a single request, the rest will hit the cache
+            handlers.get(MessageMode.TFL).prefetch(self.station_ids)
+        payloads = [
+            make_payload(json.loads(message.to_message_body()))
+            for message, _ in targets
+        ]
+        render_latency = time.perf_counter() - start
+        self.render_latencies.append(render_latency)
+
+        self._sleep_until(slot_time)
+        jitter = time.time() - slot_time
+        self.jitters.append(jitter)
+        for (message, devices), payload in zip(targets, payloads):
+            results = send(payload, devices)
+            statuses = {
+                name: None if result is None else result["statusCode"]
+                for name, result in results.items()
+            }
+            print(
+                f"{message.mode}: render {1e3 * render_latency:.0f}ms, "
+                f"jitter {1e3 * jitter:+.0f}ms, statuses {statuses}"
+            )
+
+    def run(self):
+        for slot_time, targets in self._slots():
+            # Don't try to catch up on slots that have already passed
+            if slot_time < time.time():
+                continue
+
+            modes = ",".join(message.mode for message, _ in targets)
+            try:
+                self.run_slot(slot_time, targets)
+            except Exception as e:
+                print(f"Failed to display {modes} messages: {e}")
+            finally:
+                tracer.flush(mode=modes)
+
+
+def main():
+    from my_config import config
+
+    daemon = Daemon(config)
+    daemon.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+
+# Seconds that a group of requests may take, this must fit inside the Lambda timeout
+DEADLINE = 8.0
+MAX_WORKERS = 8
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+
+def _limited(call, semaphore):
+    with semaphore:
+        return call()
+
+
+def gather(*calls, deadline: float = DEADLINE, limit: int | None = None):
+    if limit is not None:
+        semaphore = threading.BoundedSemaphore(limit)
+        calls = [partial(_limited, call, semaphore) for call in calls]
+
+    futures = [executor.submit(call) for call in calls]
+    done, _ = wait(futures, timeout=deadline)
+
+    results = []
+    for future in futures:
+        if future not in done:
+            print(f"Request missed the {deadline}s deadline")
+            results.append(None)
+            continue
+
+        try:
+            results.append(future.result())
+        except Exception as e:
+            print(f"Request failed: {e}")
+            results.append(None)
+    return results
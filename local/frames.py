@@ -0,0 +1,74 @@
+import struct
+
+from PIL import Image
+
+# Frames are stored as bytes, rather than base64 in JSON, in the queue
+MAGIC = b"PX"
+VERSION = 1
+HEADER = struct.Struct("<2sBBBH")
+SIZE = 64
+FRAME_BYTES = SIZE * SIZE * 3
+
+# The dashboards only use a handful of colours, so pixels fit in 4 bits
+RAW = 0
+PALETTE = 1
+MAX_COLOURS = 16
+
+
+def _stack(frames: list[Image]):
+    # Animations are packed as one tall image, so each step runs once
+    if len(frames) == 1:
+        return frames[0]
+    stacked = Image.new("RGB", (SIZE, SIZE * len(frames)))
+    for i, frame in enumerate(frames):
+        stacked.paste(frame, (0, SIZE * i))
+    return stacked
+
+
+def pack_frames(frames: list[Image], speed: int = 0) -> bytes:
+    if not 0 < len(frames) < 256:
+        raise ValueError(f"Between 1 and 255 frames can be packed, not {len(frames)}")
+    for frame in frames:
+        if frame.size != (SIZE, SIZE):
+            raise ValueError(
+                f"Pixoo images must be 64x64, but the image size was {frame.size}"
+            )
+    image = _stack([frame.convert("RGB") for frame in frames])
+
+    colours = image.getcolors(MAX_COLOURS)
+    if colours is not None:
+        # Median cut keeps every colour, when there are no more than it's asked for
+        indexed = image.quantize(
+            len(colours), method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE
+        )
+        if indexed.convert("RGB").tobytes() == image.tobytes():
+            palette = bytes(indexed.getpalette()[: 3 * len(colours)])
+            return (
+                HEADER.pack(MAGIC, VERSION, PALETTE, len(frames), speed)
+                + bytes([len(colours)])
+                + palette
+                + indexed.tobytes("raw", "P;4")
+            )
+
+    return HEADER.pack(MAGIC, VERSION, RAW, len(frames), speed) + image.tobytes()
+
+
+def unpack_frames(blob: bytes):
+    # Returns the RGB bytes of every frame in one buffer, ready to be base64 encoded
+    magic, version, kind, count, speed = HEADER.unpack_from(blob)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("The frames were not packed by this version of pack_frames")
+
+    body = memoryview(blob)[HEADER.size :]
+    if kind == RAW:
+        if len(body) != count * FRAME_BYTES:
+            raise ValueError(f"Expected {count} frames, got {len(body)} bytes")
+        return body, count, speed
+
+    palette_size = 3 * body[0]
+    palette = body[1 : 1 + palette_size].tobytes()
+    indexed = Image.frombytes(
+        "P", (SIZE, SIZE * count), body[1 + palette_size :], "raw", "P;4"
+    )
+    indexed.putpalette(palette)
+    return indexed.convert("RGB").tobytes(), count, speed
@@ -0,0 +1,160 @@
+import html
+import re
+
+# Rows and cells don't have to be closed in HTML, so a row ends at the next one
+TBODY = re.compile(rb"<tbody\b", re.IGNORECASE)
+ROW = re.compile(rb"<tr\b", re.IGNORECASE)
+ROW_END = re.compile(rb"</?t(?:r|body|able)\b", re.IGNORECASE)
+CELL = re.compile(rb"<t[dh]\b[^>]*>", re.IGNORECASE)
+CELL_END = re.compile(rb"</?t(?:[dhr]|body|able)\b", re.IGNORECASE)
+TAG_NAME = re.compile(rb"</?[a-z][a-z0-9]*", re.IGNORECASE)
+TAG = re.compile(r"<[^>]*>")
+# Every tag but the start of a cell, so a row's cells are cleaned in one pass
+NON_CELL_TAG = re.compile(r"<(?!t[dh]\b)[^>]*>", re.IGNORECASE)
+CELL_TEXT = re.compile(r"<t[dh]\b[^>]*>", re.IGNORECASE)
+# Tags that end the walk back from a cell to the start of its row
+TABLE_TAGS = {
+    b"<td",
+    b"</td",
+    b"<th",
+    b"</th",
+    b"</tr",
+    b"<thead",
+    b"</thead",
+    b"<tbody",
+    b"</tbody",
+    b"<tfoot",
+    b"</tfoot",
+    b"<table",
+    b"</table",
+}
+
+
+def _clean_cell(cell):
+    if "&" in cell:
+        cell = html.unescape(cell)
+    return cell.strip()
+
+
+def _first_cell_row(data, position, first_row=0):
+    # Where the row starts, if position is in its first cell, walking back over
+    # the few tags in between rather than looking for the start of every row
+    in_cell = False
+    index = position + 1
+    while True:
+        index = data.rfind(b"<", first_row, index)
+        if index == -1:
+            return -1
+        tag = TAG_NAME.match(data, index)
+        # A tag at the end might be cut short, i.e. "<tr" of "<track"
+        if tag is None or tag.end() == len(data):
+            continue
+        name = tag[0].lower()
+        if name == b"<tr":
+            return index
+        if name in (b"<td", b"<th") and not in_cell:
+            in_cell = True
+        elif name in TABLE_TAGS:
+            return -1
+
+
+def _is_first_cell(data, start, end, first_cell):
+    cell = CELL.search(data, start, end)
+    if cell is None:
+        return False
+    cell_end = CELL_END.search(data, cell.end(), end)
+    cell_end = end if cell_end is None else cell_end.start()
+    # Tags are ASCII, so cells can be cut from the bytes and decoded on their own
+    cell = data[cell.end() : cell_end].decode("utf-8", errors="replace")
+    return _clean_cell(TAG.sub("", cell)) == first_cell
+
+
+def _find_row_end(data, start):
+    row_end = ROW_END.search(data, start)
+    # The next chunk might continue the tag, i.e. "<tr" of "<track"
+    if row_end is None or row_end.end() == len(data):
+        return None
+    return row_end
+
+
+def _parse_row(data, start, end):
+    row = NON_CELL_TAG.sub("", data[start:end].decode("utf-8", errors="replace"))
+    cells = [_clean_cell(cell) for cell in CELL_TEXT.split(row)[1:]]
+    return cells or None
+
+
+def _scan_first_rows(data):
+    # Returns the cells of the first row, or where the incomplete one starts
+    row = ROW.search(data)
+    while row is not None:
+        row_end = _find_row_end(data, row.end())
+        if row_end is None:
+            return None, row.start()
+        cells = _parse_row(data, row.start(), row_end.start())
+        if cells is not None:
+            return cells, None
+        row = ROW.search(data, row_end.start())
+    return None, data.rfind(b"<")
+
+
+def _scan_matching_rows(data, first_cell, needle):
+    # Only the rows with the first cell's bytes, or an entity that could spell
+    # them, in their first cell are parsed, so most of the page is skipped in C
+    first_row = ROW.search(data)
+    if first_row is None:
+        return None, data.rfind(b"<")
+    first_row = first_row.start()
+    hit = data.find(needle, first_row)
+    entity = data.find(b"&", first_row)
+    while hit != -1 or entity != -1:
+        position = entity if hit == -1 or -1 < entity < hit else hit
+        start = _first_cell_row(data, position, first_row)
+        end = position + 1
+        if start != -1:
+            row_end = _find_row_end(data, start + 1)
+            if row_end is None:
+                return None, start
+            end = row_end.start()
+            if _is_first_cell(data, start, end, first_cell):
+                return _parse_row(data, start, end), None
+
+        if hit != -1 and hit < end:
+            hit = data.find(needle, end)
+        if entity != -1 and entity < end:
+            entity = data.find(b"&", end)
+
+    # The last row is kept if its first cell might not have arrived yet
+    start = _first_cell_row(data, len(data) - 1, first_row)
+    return None, data.rfind(b"<") if start == -1 else start
+
+
+def find_row(chunks, first_cell: str | None = None, tbody_only: bool = False):
+    # Scan the raw bytes as they arrive, and stop as soon as the row is found
+    needle = None if first_cell is None else first_cell.encode("utf-8")
+    data = b""
+    in_tbody = not tbody_only
+    for chunk in chunks:
+        data += chunk
+        if not in_tbody:
+            tbody = TBODY.search(data)
+            if tbody is None or tbody.end() == len(data):
+                data = data[-len(b"<tbody") :]
+                continue
+            in_tbody = True
+            data = data[tbody.start() :]
+
+        if first_cell is None:
+            cells, start = _scan_first_rows(data)
+        else:
+            cells, start = _scan_matching_rows(data, first_cell, needle)
+        if cells is not None:
+            return cells
+
+        # The last row might not be complete yet, so it's kept for the next chunk
+        data = b"" if start == -1 else data[start:]
+
+    if not in_tbody or ROW.match(data) is None:
+        return None
+    if first_cell is None or _is_first_cell(data, 0, len(data), first_cell):
+        return _parse_row(data, 0, len(data))
+    return None
@@ -1,13 +1,24 @@
 import os
 from dataclasses import dataclass
 from datetime import datetime
+from functools import cached_property, partial
 
 import urllib3
+from cache import Cache, make_cache
+from fetch import MAX_WORKERS, gather
+from html_table import find_row
 from pen import Colours, Pen
-from PIL import Image
-from s3_cache import S3Cache
+from tracing import span
 from urllib3 import make_headers
 
+# Hours (local time) on a Saturday during which results are published
+RESULTS_WINDOW = (10, 22)
+# Seconds before a runner without a result is checked again, doubling each attempt
+RETRY_BACKOFF = 300
+MAX_RETRY_BACKOFF = 3600
+# The proxy is rate limited, so only scrape a few runners at a time
+MAX_CONCURRENT_SCRAPES = 4
+
 
 @dataclass
 class Runner:
@@ -22,16 +33,21 @@ class Runner:
 
 
 class Parkrun:
-    def __init__(self, cache: S3Cache):
+    def __init__(
+        self,
+        cache: Cache,
+        pen: Pen | None = None,
+        pool_manager: urllib3.PoolManager | None = None,
+    ):
         self.cache = cache
 
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36",
             "Accept-Language": "en-US,en;q=0.9",
         }
-        self.pool_manager = self._get_pool_manager()
-        self.pen = Pen()
-        self.logo = Image.open("assets/parkrun/logo.png")
+        self.pool_manager = self._get_pool_manager(pool_manager)
+        self.pen = pen or Pen()
+        self.logo = self.pen.load_icon("assets/parkrun/logo.png")
         self.position_to_colour = {
             0: Colours.GOLD,
             1: Colours.SILVER,
@@ -43,9 +59,9 @@ class Parkrun:
         self.now_weekday = None
 
     @staticmethod
-    def _get_pool_manager():
+    def _get_pool_manager(pool_manager):
         if os.environ.get("LAMBDA_ENV") is None:
-            return urllib3.PoolManager()
+            return pool_manager or urllib3.PoolManager()
 
         url = os.environ.get("PROXY_URL")
         if url is None:
@@ -61,44 +77,37 @@ class Parkrun:
         return urllib3.ProxyManager(
             proxy_url=proxy_url,
             proxy_headers=proxy_headers,
+            maxsize=MAX_WORKERS,
         )
 
-    @staticmethod
-    def _clean_cell(cell):
-        while "<" in cell:
-            start = cell.find("<")
-            end = cell.find(">", start)
-            cell = cell[:start] + cell[end + 1 :]
-        cell = cell.strip()
-        return cell
-
     def _update_now(self):
         self.now = datetime.now()
         self.now_date = self.now.strftime("%d/%m/%Y")
         self.now_timestamp = self.now.timestamp()
         self.now_weekday = self.now.weekday()
 
-    def _get_html(self, id_):
+    def _get_row(self, id_):
         url = f"https://www.parkrun.org.uk/parkrunner/{id_}"
         response = self.pool_manager.request(
-            method="GET", url=url, headers=self.headers
+            method="GET",
+            url=url,
+            headers=self.headers,
+            timeout=5.0,
+            preload_content=False,
         )
-        if response.status != 200:
-            print(f"Parkrun API error: {response.status}")
-            return None
+        try:
+            if response.status != 200:
+                print(f"Parkrun API error: {response.status}")
+                return None
 
-        html = response.data.decode("utf-8")
-        return html
-
-    def _parse_html(self, html):
-        start_tbody = html.find("<tbody>")
-        start_tr = html.find("<tr", start_tbody)
-        end_tr = html.find("</tr>", start_tr)
-        first_row_html = html[start_tr:end_tr]
-        cells = first_row_html.split("<td>")[1:]
-        event, date, gender_position, position, time, age_grade = [
-            self._clean_cell(cell) for cell in cells
-        ]
+            # The most recent run is the first row, so the rest of the page isn't read
+            return find_row(response.stream(16384), tbody_only=True)
+        finally:
+            response.close()
+
+    @staticmethod
+    def _parse_row(cells):
+        event, date, gender_position, position, time, age_grade = cells[:6]
         minutes, seconds = time.split(":")
         time_in_seconds = 60 * int(minutes) + int(seconds)
         stats = {
@@ -111,34 +120,72 @@ class Parkrun:
         }
         return stats
 
+    def _is_publishing(self):
+        start_hour, end_hour = RESULTS_WINDOW
+        return self.now_weekday == 5 and start_hour <= self.now.hour < end_hour
+
+    def _scrape(self, id_):
+        with span("fetch_parkrun"):
+            cells = self._get_row(id_)
+        if cells is None:
+            print(f'Failed to get HTML for "{id_}"')
+            return None
+
+        try:
+            return self._parse_row(cells)
+        except ValueError as e:
+            print(f'Failed to parse HTML for "{id_}": {e}')
+            return None
+
     def _get_stats(self, ids):
         key = "results.json"
-        stats, last_updated = self.cache.get(key)
-        if last_updated is not None:
-            recently_checked = (self.now_timestamp - last_updated) < 1800
-            not_saturday = self.now_weekday != 5
-            if recently_checked or not_saturday:
-                return stats
-
-        update = False
+        stats, _ = self.cache.get(key)
+        if not self._is_publishing():
+            return stats
+
+        # When each runner without a result for today should be checked again
+        checks_key = "results_checks.json"
+        checks, _ = self.cache.get(checks_key)
+        if checks.get("date") != self.now_date:
+            checks = {"date": self.now_date, "runners": {}}
+
+        missing_ids = []
         for id_ in ids:
             cached_stats = stats.get(id_)
+            if cached_stats is not None and cached_stats["date"] == self.now_date:
+                continue
 
-            if cached_stats is not None:
-                correct_date = cached_stats["date"] == self.now_date
-                if correct_date:
-                    continue
-
-            html = self._get_html(id_)
-            if html is None:
-                print(f'Failed to get HTML for "{id_}"')
+            check = checks["runners"].get(id_)
+            if check is not None and self.now_timestamp < check["next_check"]:
                 continue
 
-            stats[id_] = self._parse_html(html)
-            update = True
+            missing_ids.append(id_)
+
+        if not missing_ids:
+            return stats
+
+        results = gather(
+            *[partial(self._scrape, id_) for id_ in missing_ids],
+            limit=MAX_CONCURRENT_SCRAPES,
+        )
+
+        for id_, runner_stats in zip(missing_ids, results):
+            if runner_stats is not None:
+                stats[id_] = runner_stats
+                if runner_stats["date"] == self.now_date:
+                    checks["runners"].pop(id_, None)
+                    continue
+
+            # The result isn't posted yet, so back off before checking again
+            attempts = checks["runners"].get(id_, {}).get("attempts", 0) + 1
+            backoff = min(RETRY_BACKOFF * 2 ** (attempts - 1), MAX_RETRY_BACKOFF)
+            checks["runners"][id_] = {
+                "attempts": attempts,
+                "next_check": self.now_timestamp + backoff,
+            }
 
-        if update:
-            self.cache.save(stats, key)
+        self.cache.save(stats, key)
+        self.cache.save(checks, checks_key)
 
         return stats
 
@@ -157,32 +204,37 @@ class Parkrun:
         runners.sort(key=lambda runner: runner.time)
         return runners
 
-    def _draw_header(self, image):
+    @cached_property
+    def background(self):
+        # The logo and title never change, so they're drawn once
+        image = self.pen.new_image(Colours.GRAY)
         text = "Parkrun"
-        image.paste(self.logo, (1, 2), self.logo)
+        self.pen.draw_icon(image, (1, 2), self.logo)
         self.pen.draw_text(
             image=image,
             xy=(self.logo.width + 3, 3),
             text=text,
             color=Colours.WHITE,
         )
+        return image
 
-        time = self.now.strftime("%H:%M")
-        time_width = self.pen.text_width(time)
-        self.pen.draw_text(
+    def _draw_header(self, image, colon):
+        self.pen.draw_clock(
             image=image,
-            xy=(63 - time_width, 4),
-            text=time,
+            y=4,
+            now=self.now,
             color=Colours.WHITE,
+            colon=colon,
         )
 
-    def make_image(self, id_to_name: dict[str, str]):
+    def _get_data(self, id_to_name):
         self._update_now()
         stats = self._get_stats(id_to_name.keys())
-        runners = self._get_runners(id_to_name, stats)
+        return self._get_runners(id_to_name, stats)
 
-        image = Image.new("RGB", (64, 64), color=Colours.GRAY)
-        self._draw_header(image)
+    def _render(self, runners, colon=True):
+        image = self.background.copy()
+        self._draw_header(image, colon)
         y = self.pen.letter_height + 5
         for position, runner in enumerate(runners):
             colour = self.position_to_colour.get(position, Colours.WHITE)
@@ -201,11 +253,21 @@ class Parkrun:
 
         return image
 
+    def make_image(self, id_to_name: dict[str, str]):
+        runners = self._get_data(id_to_name)
+        return self._render(runners)
+
+    def make_frames(self, id_to_name: dict[str, str], animate: bool = False):
+        runners = self._get_data(id_to_name)
+        colons = [True, False] if animate else [True]
+        with span("render"):
+            return [self._render(runners, colon) for colon in colons]
+
 
 def main():
     from my_config import parkrun_message
 
-    cache = S3Cache()
+    cache = make_cache()
     parkrun = Parkrun(cache)
     image = parkrun.make_image(parkrun_message.id_to_name)
     image.save("../parkrun.png")
@@ -1,5 +1,7 @@
 import string
 from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache
 
 from PIL import Image
 
@@ -16,24 +18,86 @@ class Colours:
     BRONZE = (205, 127, 50)
 
 
+class Palette:
+    # Colours are only ever added, so the index of a colour never changes
+    def __init__(self, colours=()):
+        self.indices = {}
+        self.data = []
+        for colour in colours:
+            self.index(colour)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def index(self, colour):
+        index = self.indices.get(colour)
+        if index is None:
+            if len(self.indices) == 256:
+                raise ValueError("The palette is full, it holds at most 256 colours")
+            index = self.indices[colour] = len(self.indices)
+            self.data.extend(colour)
+        return index
+
+
+@dataclass(frozen=True)
+class Icon:
+    # Palette indices, and the 1-bit mask of the pixels to draw
+    image: Image
+    mask: Image
+
+    @property
+    def width(self):
+        return self.image.width
+
+    @property
+    def height(self):
+        return self.image.height
+
+
+def _to_mask(image):
+    # The assets are either fully transparent or fully opaque
+    return image.getchannel("A").point(lambda alpha: 255 if alpha >= 128 else 0, "1")
+
+
 class Pen:
-    def __init__(self):
-        self.glyphs = {
-            letter: Image.open(f"assets/letters/{letter}.png")
-            for letter in string.ascii_uppercase
+    def __init__(self, cache_size: int = 256):
+        paths = {
+            letter: f"assets/letters/{letter}.png" for letter in string.ascii_uppercase
         }
-        self.glyphs.update(
-            {
-                str(number): Image.open(f"assets/numbers/{number}.png")
-                for number in range(10)
-            }
+        paths.update(
+            {str(number): f"assets/numbers/{number}.png" for number in range(10)}
         )
-        self.glyphs[":"] = Image.open("assets/letters/colon.png")
-        self.glyphs["°"] = Image.open("assets/letters/degrees.png")
-        self.glyphs["%"] = Image.open("assets/letters/percent.png")
+        paths[":"] = "assets/letters/colon.png"
+        paths["°"] = "assets/letters/degrees.png"
+        paths["%"] = "assets/letters/percent.png"
+
+        # Frames are drawn in palette indices, and only expanded to RGB when encoded
+        self.palette = Palette(
+            value for name, value in vars(Colours).items() if name.isupper()
+        )
+
+        # Load every glyph once into a single sheet of 1-bit masks
+        images = {char: Image.open(path) for char, path in paths.items()}
+        width = sum(image.width for image in images.values())
+        height = max(image.height for image in images.values())
+        self.atlas = Image.new("1", (width, height))
+        self.glyphs = {}
+        x = 0
+        for char, image in images.items():
+            box = (x, 0, x + image.width, image.height)
+            self.atlas.paste(_to_mask(image), box)
+            self.glyphs[char] = self.atlas.crop(box)
+            x += image.width
+
         self.letter_height = self.glyphs["A"].height
         self.number_height = self.glyphs["0"].height
 
+        # Rendered text masks, keyed by text, as the colour is only used when pasting
+        self._render_text = lru_cache(maxsize=cache_size)(self._render_text_uncached)
+
+    def cache_info(self):
+        return self._render_text.cache_info()
+
     def text_width(self, text):
         text_width = len(text) - 1
         for char in text.upper():
@@ -43,17 +107,76 @@ class Pen:
                 text_width += self.glyphs[char].width
         return text_width
 
-    def draw_text(
-        self, image: Image, xy: tuple[int, int], text: str, color: tuple[int, int, int]
-    ):
-        x, y = xy
-        for char in text.upper():
+    def new_image(self, color: tuple[int, int, int]):
+        image = Image.new("P", (64, 64), self.palette.index(color))
+        self._sync_palette(image)
+        return image
+
+    def load_icon(self, path: str):
+        image = Image.open(path).convert("RGBA")
+        mask = _to_mask(image)
+        indices = bytes(
+            self.palette.index((red, green, blue)) if alpha else 0
+            for red, green, blue, alpha in image.get_flattened_data()
+        )
+        icon = Image.frombytes("P", image.size, indices)
+        self._sync_palette(icon)
+        return Icon(icon, mask)
+
+    def _sync_palette(self, image):
+        # Colours added after the image was made, i.e. by another dashboard's icons
+        if image.info.get("colours") != len(self.palette):
+            image.putpalette(self.palette.data)
+            image.info["colours"] = len(self.palette)
+
+    def _fill(self, image, color):
+        if image.mode != "P":
+            return color
+        index = self.palette.index(color)
+        self._sync_palette(image)
+        return index
+
+    def draw_icon(self, image: Image, xy: tuple[int, int], icon: Icon):
+        if image.mode == "P":
+            self._sync_palette(image)
+        image.paste(icon.image, xy, icon.mask)
+
+    def _render_text_uncached(self, text):
+        mask = Image.new("1", (self.text_width(text), self.atlas.height))
+        x = 0
+        for char in text:
             if char == " ":
                 x += 2
                 continue
 
             glyph = self.glyphs[char]
-            background = Image.new("RGBA", glyph.size, color=color)
-            image.paste(background, (x, y), glyph)
-
+            mask.paste(glyph, (x, 0))
             x += glyph.width + 1
+        return mask
+
+    def draw_text(
+        self, image: Image, xy: tuple[int, int], text: str, color: tuple[int, int, int]
+    ):
+        if not text:
+            return
+
+        mask = self._render_text(text.upper())
+        image.paste(self._fill(image, color), xy, mask)
+
+    def draw_clock(
+        self,
+        image: Image,
+        y: int,
+        now: datetime,
+        color: tuple[int, int, int],
+        colon: bool = True,
+    ):
+        text = now.strftime("%H:%M")
+        if colon:
+            self.draw_text(image, (63 - self.text_width(text), y), text, color)
+            return
+
+        # Keep the digits in place, so that the clock doesn't jump between frames
+        hours, minutes = text.split(":")
+        self.draw_text(image, (63 - self.text_width(text), y), hours, color)
+        self.draw_text(image, (63 - self.text_width(minutes), y), minutes, color)
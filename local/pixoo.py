@@ -1,39 +1,236 @@
 import base64
+import hashlib
 import json
 import os
+import time
+from dataclasses import asdict, dataclass
 
 import urllib3
+from cache import Cache
+from config import DEFAULT_DEVICE
+from frames import unpack_frames
 from PIL import Image
+from tracing import span
+
+# Seconds after which an unchanged frame is sent again, in case the display changed
+MAX_UNCHANGED_AGE = 600
+
+# The Pixoo handles one request at a time, so a single kept-alive connection is reused
+POOL_SIZE = 1
+# Connecting through the router's port forwarding should be quick, drawing can be slower
+TIMEOUT = urllib3.Timeout(connect=2.0, read=3.0)
+# Drawing a frame twice is harmless, so a failed connection is retried once,
+# but a Pixoo that's stopped responding isn't waited for twice
+RETRIES = urllib3.Retry(total=1, connect=1, read=0, allowed_methods=None)
+# Failures in a row before the Pixoo is assumed to be unreachable
+FAILURE_THRESHOLD = 3
+# Seconds before an unreachable Pixoo is tried again
+BREAKER_COOLDOWN = 60
+
+
+@dataclass
+class PushStats:
+    pushed: int = 0
+    skipped: int = 0
+    failed: int = 0
+    short_circuited: int = 0
+    bytes_sent: int = 0
+    bytes_saved: int = 0
+    posts: int = 0
+    post_seconds: float = 0.0
+
+
+def get_device_urls():
+    # Several devices are set as PIXOO_URLS="kitchen=http://...,hall=http://..."
+    urls = os.environ.get("PIXOO_URLS")
+    if not urls:
+        return {DEFAULT_DEVICE: os.environ["PIXOO_URL"]}
+
+    device_urls = {}
+    for device_url in urls.split(","):
+        name, url = device_url.split("=", 1)
+        device_urls[name.strip()] = url.strip()
+    return device_urls
 
 
 class Pixoo:
-    def __init__(self):
-        self.pool_manager = urllib3.PoolManager()
-        self.pixoo_url = os.environ["PIXOO_URL"]
+    def __init__(
+        self,
+        pool_manager: urllib3.PoolManager | None = None,
+        cache: Cache | None = None,
+        url: str | None = None,
+        name: str = DEFAULT_DEVICE,
+    ):
+        self.name = name
+        self.pixoo_url = url or os.environ["PIXOO_URL"]
+        self.pool = (pool_manager or urllib3.PoolManager()).connection_from_url(
+            self.pixoo_url, pool_kwargs={"maxsize": POOL_SIZE, "block": True}
+        )
+        # The pool is already connected to the host, so requests only send the path,
+        # as a PoolManager would, rather than the absolute URL
+        self.request_uri = urllib3.util.parse_url(self.pixoo_url).request_uri
+        self.cache = cache
+        self.cache_key = (
+            f"pixoo_{hashlib.md5(self.pixoo_url.encode('utf-8')).hexdigest()}.json"
+        )
+        self.state = {}
+        self.stats = PushStats()
+
+    @staticmethod
+    def encode_frames(frames: list[Image]):
+        buffers = []
+        for frame in frames:
+            size = (frame.width, frame.height)
+            if size != (64, 64):
+                raise ValueError(
+                    f"Pixoo images must be 64x64, but the image size was {size}"
+                )
+
+            if frame.mode != "RGB":
+                frame = frame.convert("RGB")
+            buffers.append(frame.tobytes())
+        return Pixoo._encode_buffer(b"".join(buffers), len(buffers))
+
+    @staticmethod
+    def _encode_buffer(buffer, count):
+        # Each frame is 64 * 64 * 3 bytes, which is a multiple of 3,
+        # so the encoded frames can be sliced out of a single base64 string
+        encoded = base64.b64encode(buffer).decode("utf-8")
+        step = len(encoded) // count
+        return [encoded[i : i + step] for i in range(0, len(encoded), step)]
 
     @staticmethod
     def encode_image(image: Image):
-        size = (image.width, image.height)
-        if size != (64, 64):
-            raise ValueError(
-                f"Pixoo images must be 64x64, but the image size was {size}"
-            )
+        return Pixoo.encode_frames([image])[0]
+
+    @staticmethod
+    def make_payload(frames: list[Image], speed: int = 0):
+        with span("encode"):
+            encoded_frames = Pixoo.encode_frames(frames)
+        return Pixoo._to_payload(encoded_frames, speed)
+
+    @staticmethod
+    def make_payload_from_blob(blob: bytes):
+        # Frames packed by the producer, see frames.pack_frames
+        with span("encode"):
+            buffer, count, speed = unpack_frames(blob)
+            encoded_frames = Pixoo._encode_buffer(buffer, count)
+        return Pixoo._to_payload(encoded_frames, speed)
+
+    @staticmethod
+    def _to_payload(encoded_frames, speed):
+        pic_id = int(time.time())
+        commands = [
+            {
+                "Command": "Draw/SendHttpGif",
+                "PicNum": len(encoded_frames),
+                "PicWidth": 64,
+                "PicOffset": offset,
+                "PicID": pic_id,
+                "PicSpeed": speed,
+                "PicData": pic_data,
+            }
+            for offset, pic_data in enumerate(encoded_frames)
+        ]
+        if len(commands) == 1:
+            return commands[0]
+
+        # Send every frame of the animation in a single request
+        return {"Command": "Draw/CommandList", "CommandList": commands}
+
+    @staticmethod
+    def _hash_payload(payload):
+        digest = hashlib.blake2b(digest_size=16)
+        for command in payload.get("CommandList", [payload]):
+            digest.update(str(command["PicSpeed"]).encode("utf-8"))
+            digest.update(command["PicData"].encode("utf-8"))
+        return digest.hexdigest()
+
+    def _get_state(self):
+        # A copy, so that the saved state can be compared with the new one
+        if self.cache is None:
+            return dict(self.state)
+
+        # Other processes may have pushed since, so revalidate, which is a conditional
+        # read that's cheap while the state hasn't changed, but never block the post
+        try:
+            state, _ = self.cache.get(self.cache_key, ttl=0)
+        except Exception as e:
+            print(f"Failed to load the state of {self.name}: {e}")
+            return dict(self.state)
+        if state:
+            self.state = state
+        return dict(self.state)
+
+    def _save_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        if self.cache is None:
+            return
+
+        try:
+            self.cache.save(state, self.cache_key)
+        except Exception as e:
+            print(f"Failed to save the state of {self.name}: {e}")
+
+    @staticmethod
+    def _skipped(reason, status_code=200):
+        return {
+            "statusCode": status_code,
+            "body": json.dumps({"status": "Skipped", "reason": reason}),
+        }
+
+    def send(self, payload):
+        size = len(json.dumps(payload))
+        frame_hash = self._hash_payload(payload)
+
+        state = self._get_state()
+        if time.time() < state.get("open_until", 0):
+            # Don't wait for the timeout on every message while the Pixoo is down
+            self.stats.short_circuited += 1
+            return self._skipped("The Pixoo is unreachable", status_code=503)
+
+        unchanged = state.get("hash") == frame_hash
+        recent = time.time() - state.get("pushed_at", 0) < MAX_UNCHANGED_AGE
+        if unchanged and recent:
+            self.stats.skipped += 1
+            self.stats.bytes_saved += size
+            return self._skipped("The frame is unchanged")
+
+        start = time.perf_counter()
+        with span(f"post_{self.name}"):
+            result = self.post(payload)
+        self.stats.posts += 1
+        self.stats.post_seconds += time.perf_counter() - start
 
-        pixels = []
-        for red, green, blue in image.getdata():
-            pixels.extend([red, green, blue])
+        if result["statusCode"] == 200:
+            self.stats.pushed += 1
+            self.stats.bytes_sent += size
+            self._save_state({"hash": frame_hash, "pushed_at": time.time()})
+        elif result["statusCode"] >= 500:
+            self.stats.failed += 1
+            state["failures"] = state.get("failures", 0) + 1
+            # After the cooldown, a single failure opens the breaker again
+            if state["failures"] >= FAILURE_THRESHOLD:
+                state["open_until"] = time.time() + BREAKER_COOLDOWN
+            self._save_state(state)
+        return result
 
-        return base64.b64encode(bytearray(pixels)).decode("utf-8")
+    def get_stats(self):
+        return asdict(self.stats)
 
     def post(self, payload):
         encoded_payload = json.dumps(payload).encode("utf-8")
         try:
-            response = self.pool_manager.request(
+            response = self.pool.request(
                 "POST",
-                self.pixoo_url,
+                self.request_uri,
                 body=encoded_payload,
                 headers={"Content-Type": "application/json"},
-                timeout=5.0,
+                timeout=TIMEOUT,
+                retries=RETRIES,
+                pool_timeout=TIMEOUT.read_timeout,
             )
 
             if response.status >= 400:
@@ -1,30 +1,249 @@
+import base64
+import json
 import os
-from datetime import datetime, timezone
+import threading
+import time
+from functools import partial
 
 import boto3
+from config import REFRESH_SECONDS, MessageMode, filter_messages, plan_minute
 from my_config import config
 
 sqs = boto3.client("sqs")
 
+# The consumer's SQS batching window, messages are sent this much early
+BATCHING_WINDOW = int(os.environ.get("BATCHING_WINDOW", "0"))
+# Render the minute's frames here, so that the consumers only have to post them
+RENDER_AHEAD = os.environ.get("RENDER_AHEAD", "false").lower() == "true"
+# Give the minute's slots to the messages whose data changes the most,
+# and skip redrawing a message that's already on screen until it's due
+ADAPTIVE_SCHEDULE = os.environ.get("ADAPTIVE_SCHEDULE", "false").lower() == "true"
+# Boards with a train due within this many seconds are redrawn in every slot
+DUE_SOON = 120
+# Seconds between redraws of a board without any trains, i.e. when it's closed
+CLOSED_REFRESH = 60
+# SQS accepts at most 10 messages, and 256KB, per batch
+MAX_BATCH_SIZE = 10
+MAX_BATCH_BYTES = 256 * 1024
+# Times that the entries SQS failed to queue, i.e. when throttled, are sent
+MAX_SEND_ATTEMPTS = 3
+# Seconds that rendering the minute ahead may take, and the seconds of the Lambda's
+# timeout that are kept for queueing it, so a hung upstream never loses the minute
+RENDER_DEADLINE = 5.0
+SEND_SECONDS = 2.0
 
-def _filter_messages(messages):
-    filtered_messages = []
 
-    weekday = datetime.now(timezone.utc).weekday()
-    for message in messages:
-        if message.weekday is not None and message.weekday != weekday:
+def _render_blobs(bodies, blobs):
+    # Imported here, so that the producer only loads the dashboards when it needs them
+    from consumer import make_blob, prefetch
+
+    # Fetch the data for the whole minute at once
+    prefetch(bodies)
+    for i, body in enumerate(bodies):
+        try:
+            # A message in several slots of the minute is only rendered once
+            blobs[i] = make_blob(body)
+        except Exception as e:
+            # The consumer will render the frame itself
+            print(f"Failed to render {body['mode']} message ahead: {e}")
+
+
+def _render_ahead(bodies, deadline=RENDER_DEADLINE):
+    # Rendering runs in a thread that's only waited for until the deadline,
+    # and the messages that aren't rendered by then are rendered by the consumer
+    blobs = {}
+    copies = [dict(body) for body in bodies]
+    thread = threading.Thread(target=_render_blobs, args=(copies, blobs), daemon=True)
+    thread.start()
+    thread.join(max(0, deadline))
+    blobs = dict(blobs)
+    if thread.is_alive():
+        print(f"Rendered {len(blobs)} of {len(bodies)} messages by the deadline")
+
+    for i, blob in blobs.items():
+        body = bodies[i]
+        # Packed frames are a few KB, rather than 16KB of base64 per frame
+        frames = base64.b64encode(blob).decode("utf-8")
+        if len(frames) > MAX_BATCH_BYTES // 2:
+            print(f"Rendered {body['mode']} message is too big to queue")
             continue
+        body["frames"] = frames
 
-        filtered_messages.append(message)
-    return filtered_messages
 
+def _get_soonest_arrivals(messages):
+    # Seconds until the first train of each board, with one request for every station
+    tfl_messages = [message for message in messages if message.mode == MessageMode.TFL]
+    if not tfl_messages:
+        return {}
 
-def lambda_handler(event, context):
-    messages = _filter_messages(config.messages)
-    for i in range(config.messages_per_minute):
-        sqs.send_message(
-            QueueUrl=os.environ["QUEUE_URL"],
-            MessageBody=messages[i % len(messages)].to_message_body(),
-            DelaySeconds=int(60 * i / config.messages_per_minute),
+    from consumer import handlers
+
+    tfl = handlers.get(MessageMode.TFL)
+    station_to_arrivals = tfl.prefetch([message.station_id for message in tfl_messages])
+    soonest = {}
+    for message in tfl_messages:
+        arrivals = station_to_arrivals[message.station_id]
+        # Boards that failed to fetch keep their usual refresh
+        if arrivals is None:
+            continue
+
+        arrivals = tfl._filter_arrivals(arrivals, message.station_id, message.inbound)
+        soonest[message] = arrivals[0].time_to_station if arrivals else None
+    return soonest
+
+
+def _get_refresh_seconds(message, soonest, render_ahead=False):
+    # Frames rendered ahead are the same in every slot of the minute,
+    # so redrawing a message within the minute would only send the same frame
+    if render_ahead:
+        return 60
+
+    if message.mode == MessageMode.TFL and message in soonest:
+        if soonest[message] is None:
+            return CLOSED_REFRESH
+        if soonest[message] < DUE_SOON:
+            return 0
+
+    if message.refresh_seconds is not None:
+        return message.refresh_seconds
+    return REFRESH_SECONDS[message.mode]
+
+
+def _rotate_by_refresh(messages, slots, refresh_seconds):
+    if len(messages) >= slots:
+        return [messages[i % len(messages)] for i in range(slots)]
+
+    # Every message is shown at least once, and the rest of the slots are shared
+    # by how many times a minute each message needs redrawing
+    slot_seconds = 60 / slots
+    weights = [60 / max(refresh_seconds(message), slot_seconds) for message in messages]
+    counts = [1] * len(messages)
+    for _ in range(slots - len(messages)):
+        i = max(range(len(messages)), key=lambda i: weights[i] / counts[i])
+        counts[i] += 1
+
+    # Consecutive slots, so that a message stays on screen between redraws
+    rotation = []
+    for message, count in zip(messages, counts):
+        rotation.extend([message] * count)
+    return rotation
+
+
+def schedule_minute(config, render_ahead=False):
+    try:
+        soonest = (
+            {}
+            if render_ahead
+            else _get_soonest_arrivals(filter_messages(config.get_messages()))
+        )
+    except Exception as e:
+        # Schedule every board with its usual refresh
+        print(f"Failed to fetch the arrivals for the schedule: {e}")
+        soonest = {}
+    refresh_seconds = partial(
+        _get_refresh_seconds, soonest=soonest, render_ahead=render_ahead
+    )
+    slots = plan_minute(
+        config, partial(_rotate_by_refresh, refresh_seconds=refresh_seconds)
+    )
+
+    # Only send a message that's already on a device once it's due a redraw
+    shown = {}
+    for i, targets in enumerate(slots):
+        delay = 60 * i / config.messages_per_minute
+        scheduled = []
+        for message, devices in targets:
+            due = []
+            for name in devices or [None]:
+                previous = shown.get(name)
+                if (
+                    previous is None
+                    or previous[0] != message
+                    or delay - previous[1] >= refresh_seconds(message)
+                ):
+                    due.append(name)
+                    shown[name] = (message, delay)
+            if due:
+                scheduled.append((message, None if devices is None else due))
+        slots[i] = scheduled
+    return slots
+
+
+def _batch(entries):
+    batch = []
+    batch_bytes = 0
+    for entry in entries:
+        entry_bytes = len(entry["MessageBody"].encode("utf-8"))
+        if batch and (
+            len(batch) == MAX_BATCH_SIZE or batch_bytes + entry_bytes > MAX_BATCH_BYTES
+        ):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(entry)
+        batch_bytes += entry_bytes
+    if batch:
+        yield batch
+
+
+def _send_batch(batch):
+    # A batch request succeeds even when some of its entries fail
+    for attempt in range(MAX_SEND_ATTEMPTS):
+        if attempt:
+            time.sleep(0.1 * 2**attempt)
+        response = sqs.send_message_batch(
+            QueueUrl=os.environ["QUEUE_URL"], Entries=batch
         )
+        failed = response.get("Failed", [])
+        if not failed:
+            return
+
+        reasons = ", ".join(f"{f['Id']}: {f['Code']}" for f in failed)
+        # Entries that SQS rejected, rather than failed to queue, would fail again
+        if any(f.get("SenderFault") for f in failed):
+            raise ValueError(f"SQS rejected the messages ({reasons})")
+        failed_ids = {f["Id"] for f in failed}
+        batch = [entry for entry in batch if entry["Id"] in failed_ids]
+
+    raise ValueError(f"SQS failed to queue the messages ({reasons})")
+
+
+def lambda_handler(event, context):
+    now = time.time()
+    ids = []
+    delays = []
+    bodies = []
+    slots = (
+        schedule_minute(config, render_ahead=RENDER_AHEAD)
+        if ADAPTIVE_SCHEDULE
+        else plan_minute(config)
+    )
+    for i, targets in enumerate(slots):
+        delay = int(60 * i / config.messages_per_minute)
+        for j, (message, devices) in enumerate(targets):
+            ids.append(f"{i}_{j}")
+            delays.append(delay)
+            bodies.append(
+                json.loads(
+                    message.to_message_body(display_at=now + delay, devices=devices)
+                )
+            )
+
+    if RENDER_AHEAD:
+        deadline = RENDER_DEADLINE
+        if context is not None:
+            remaining = context.get_remaining_time_in_millis() / 1000
+            deadline = min(deadline, remaining - SEND_SECONDS)
+        _render_ahead(bodies, deadline)
+
+    entries = [
+        {
+            "Id": id_,
+            "MessageBody": json.dumps(body),
+            "DelaySeconds": max(0, delay - BATCHING_WINDOW),
+        }
+        for id_, delay, body in zip(ids, delays, bodies)
+    ]
+    for batch in _batch(entries):
+        _send_batch(batch)
     return None
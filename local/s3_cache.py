@@ -2,27 +2,35 @@ import json
 import os
 
 import boto3
+from botocore.exceptions import ClientError
+from cache import NotModified
 
 
 class S3Cache:
-    def __init__(self):
-        self.s3 = boto3.client("s3")
-        self.bucket_name = os.environ["BUCKET_NAME"]
+    def __init__(self, s3=None, bucket_name: str | None = None):
+        self.s3 = s3 or boto3.client("s3")
+        self.bucket_name = bucket_name or os.environ["BUCKET_NAME"]
 
-    def get(self, key):
+    def get(self, key, etag=None):
+        kwargs = {} if etag is None else {"IfNoneMatch": etag}
         try:
-            response = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=key, **kwargs)
         except self.s3.exceptions.NoSuchKey:
-            return {}, None
+            return {}, None, None
+        except ClientError as e:
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] == 304:
+                raise NotModified(key) from e
+            raise
 
         last_updated = response["LastModified"].timestamp()
         results = json.loads(response["Body"].read().decode("utf-8"))
-        return results, last_updated
+        return results, last_updated, response["ETag"]
 
     def save(self, results, key):
-        self.s3.put_object(
+        response = self.s3.put_object(
             Bucket=self.bucket_name,
             Key=key,
             Body=json.dumps(results),
             ContentType="application/json",
         )
+        return response["ETag"]
@@ -0,0 +1,180 @@
+import json
+import os
+import re
+from dataclasses import dataclass
+from functools import cached_property
+
+import urllib3
+
+# Only the hand-tuned stations below are committed, run main to add the rest of TfL's
+STATIONS_PATH = "assets/tfl/stations.tsv"
+COLUMNS = [
+    "station_id",
+    "nickname",
+    "code",
+    "underground",
+    "aliases",
+    "inbound_exceptions",
+    "outbound_exceptions",
+]
+# Characters of a nickname that fit on a departure board, next to the minutes
+NICKNAME_LENGTH = 11
+PARENTHESES = re.compile(r"\(.*?\)")
+# Stop types of the stations that trains stop at, rather than entrances or platforms
+STATION_STOP_TYPES = {"NaptanMetroStation", "NaptanRailStation"}
+STATION_MODES = ["tube", "overground", "elizabeth-line", "dlr"]
+
+
+@dataclass(frozen=True)
+class Station:
+    station_id: str
+    nickname: str
+    code: str
+    underground: bool
+
+
+# Shortcuts for configs, every station is listed in the stations file
+@dataclass(frozen=True)
+class Stations:
+    BATTERSEA_POWER_STATION: Station = Station("940GZZBPSUST", "battersea", "BPS", True)
+    BELSIZE_PARK: Station = Station("940GZZLUBZP", "belsize", "BZP", True)
+    GOLDERS_GREEN: Station = Station("940GZZLUGGN", "golders", "GGN", True)
+    EDGWARE: Station = Station("940GZZLUEGW", "edgware", "EDG", True)
+    KENNINGTON: Station = Station("940GZZLUKNG", "kennington", "KEN", True)
+    MORDEN: Station = Station("940GZZLUMDN", "morden", "MDN", True)
+    EUSTON: Station = Station("940GZZLUEUS", "euston", "EUS", True)
+    HAMPSTEAD_HEATH: Station = Station("910GHMPSTDH", "heath", "HDH", False)
+    STRATFORD: Station = Station("910GSTFD", "stratford", "SRA", False)
+    CLAPHAM_JUNCTION: Station = Station("910GCLPHMJ1", "clapham", "CLJ", False)
+    RICHMOND: Station = Station("910GRICHMND", "richmond", "RMD", False)
+    WILLESDEN_JUNCTION: Station = Station("910GWLSDJHL", "willesden", "WIJ", False)
+    KENSAL_RISE: Station = Station("910GKENR", "kensal rise", "KNR", False)
+    SOUTH_ACTON: Station = Station("910GSACTON", "south acton", "SAT", False)
+    SHEPHERDS_BUSH: Station = Station("910GSHPDSB", "sheps bush", "SPB", False)
+
+
+def _split_ids(field):
+    return frozenset(field.split(",")) if field else frozenset()
+
+
+class StationRegistry:
+    def __init__(self, path: str = STATIONS_PATH):
+        self.path = path
+
+    @cached_property
+    def _tables(self):
+        # Loaded on first use, so that importing the registry is free
+        id_to_station = {}
+        alias_to_id = {}
+        exceptions = {}
+        with open(self.path, encoding="utf-8") as f:
+            next(f)
+            for line in f:
+                station_id, nickname, code, underground, aliases, inbound, outbound = (
+                    line.rstrip("\n").split("\t")
+                )
+                id_to_station[station_id] = Station(
+                    station_id, nickname, code, underground == "1"
+                )
+                # Most stations have no aliases or exceptions
+                if aliases:
+                    for alias in aliases.split(","):
+                        alias_to_id[alias] = station_id
+                if inbound:
+                    exceptions[(station_id, "inbound")] = _split_ids(inbound)
+                if outbound:
+                    exceptions[(station_id, "outbound")] = _split_ids(outbound)
+        return id_to_station, alias_to_id, exceptions
+
+    def __len__(self):
+        return len(self._tables[0])
+
+    def __contains__(self, station_id):
+        return self.canonical_id(station_id) in self._tables[0]
+
+    def __getitem__(self, station_id) -> Station:
+        return self._tables[0][self.canonical_id(station_id)]
+
+    def get(self, station_id, default=None):
+        return self._tables[0].get(self.canonical_id(station_id), default)
+
+    def canonical_id(self, station_id):
+        return self._tables[1].get(station_id, station_id)
+
+    def direction_exceptions(self, station_id, direction):
+        # Destinations that count as the direction, even when TfL leaves it blank
+        return self._tables[2].get((station_id, direction), frozenset())
+
+
+STATIONS = StationRegistry()
+
+
+def _make_nickname(common_name):
+    # i.e. "Paddington (Elizabeth line) Rail Station" is "paddington"
+    name = " ".join(PARENTHESES.sub("", common_name).split())
+    for suffix in ["Underground Station", "Rail Station", "DLR Station", "Station"]:
+        name = name.removesuffix(suffix).strip()
+    name = name.lower()
+    if len(name) <= NICKNAME_LENGTH:
+        return name
+
+    # Long names are cut at the last word that fits on the board, if there is one
+    words = name[: NICKNAME_LENGTH + 1].rsplit(" ", 1)[0].rstrip(" &-")
+    return words if " " in name[: NICKNAME_LENGTH + 1] else name[:NICKNAME_LENGTH]
+
+
+def _read_rows(path):
+    with open(path, encoding="utf-8") as f:
+        next(f)
+        return {row[0]: row for row in (line.rstrip("\n").split("\t") for line in f)}
+
+
+def _write_rows(path, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\t".join(COLUMNS) + "\n")
+        for station_id in sorted(rows):
+            f.write("\t".join(rows[station_id]) + "\n")
+
+
+def _merge_stop_points(stop_points, known_rows):
+    # Every station that trains stop at, with the hand-tuned rows kept as they are
+    rows = {}
+    for stop_point in stop_points:
+        if stop_point["stopType"] not in STATION_STOP_TYPES:
+            continue
+
+        station_id = stop_point["naptanId"]
+        rows[station_id] = [
+            station_id,
+            _make_nickname(stop_point["commonName"]),
+            "",
+            "1" if "tube" in stop_point["modes"] else "0",
+            "",
+            "",
+            "",
+        ]
+    rows.update(known_rows)
+
+    # TfL lists some stations twice, so drop the duplicates of known stations
+    for row in list(rows.values()):
+        for alias in _split_ids(row[4]):
+            rows.pop(alias, None)
+    return rows
+
+
+def main():
+    # Rebuild the station file from TfL, keeping any hand-tuned rows
+    app_key = os.environ["TFL_APP_KEY"]
+    url = f"https://api.tfl.gov.uk/StopPoint/Mode/{','.join(STATION_MODES)}?APP_KEY={app_key}"
+    response = urllib3.PoolManager().request("GET", url, timeout=60.0)
+    if response.status != 200:
+        raise ValueError(f"TfL API Error: {response.status}")
+
+    stop_points = json.loads(response.data.decode("utf-8"))["stopPoints"]
+    rows = _merge_stop_points(stop_points, _read_rows(STATIONS_PATH))
+    _write_rows(STATIONS_PATH, rows)
+    print(f"Saved {len(rows)} stations to {STATIONS_PATH}")
+
+
+if __name__ == "__main__":
+    main()
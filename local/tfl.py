@@ -1,118 +1,185 @@
+import codecs
+import heapq
 import json
 import os
+import re
+import threading
+import time
+from concurrent.futures import Future
 from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 
 import urllib3
 from pen import Colours, Pen
 from PIL import Image
+from stations import STATIONS
+from tracing import span
+
+# Seconds that a station's arrivals are reused for, i.e. by inbound and outbound messages
+ARRIVALS_TTL = 20
+
+# Rows of arrivals that fit on the screen
+MAX_ARRIVALS = 6
+
+# The gaps between the arrivals in the response's array
+SEPARATORS = re.compile(r"[\s,\[]*")
+# The end of the last complete arrival in the buffer, only nested objects are followed
+# by "}" rather than ","
+LAST_ARRIVAL_END = re.compile(r".*\}\s*,", re.DOTALL)
+
+
+# Not frozen, as a frozen dataclass takes three times as long to build
+@dataclass(slots=True)
+class Arrival:
+    naptan_id: str
+    destination_naptan_id: str
+    direction: str
+    time_to_station: int
+    towards: str
+    destination_name: str
+
+
+def _to_arrival(d, canonical_id=STATIONS.canonical_id):
+    # Keep only the fields that are drawn, nested objects (i.e. timing) are dropped
+    try:
+        naptan_id = d["naptanId"]
+        time_to_station = d["timeToStation"]
+    except KeyError:
+        return None
+
+    # Positional arguments, as this runs for every arrival in the response
+    return Arrival(
+        canonical_id(naptan_id),
+        canonical_id(d.get("destinationNaptanId", "")),
+        d.get("direction", ""),
+        time_to_station,
+        d.get("towards", ""),
+        d.get("destinationName", ""),
+    )
+
+
+def _decode_each(decoder, buffer, index):
+    # One arrival at a time, up to the first one that isn't complete yet
+    arrivals = []
+    while True:
+        index = SEPARATORS.match(buffer, index).end()
+        if index == len(buffer) or buffer[index] == "]":
+            return arrivals, index
+
+        try:
+            arrival, index = decoder.raw_decode(buffer, index)
+        except json.JSONDecodeError:
+            return arrivals, index
+        arrivals.append(arrival)
+
+
+def parse_arrivals(chunks):
+    # Decode the arrivals a chunk at a time, so the full response is never held in memory
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    for chunk in chunks:
+        buffer += utf8.decode(chunk)
+        start = SEPARATORS.match(buffer).end()
+        last = LAST_ARRIVAL_END.match(buffer, start)
+        if last is None:
+            continue
+
+        # Every arrival before the last "}," is complete, unless the "}," was in a
+        # string, in which case the batch won't decode and they're decoded one by one
+        end = last.end() - 1
+        try:
+            arrivals = json.loads(f"[{buffer[start:end]}]")
+        except json.JSONDecodeError:
+            arrivals, end = _decode_each(decoder, buffer, start)
 
+        for d in arrivals:
+            arrival = _to_arrival(d)
+            if arrival is not None:
+                yield arrival
+        buffer = buffer[end:]
 
-@dataclass(frozen=True)
-class Station:
-    station_id: str
-    nickname: str
-    code: str
-    underground: bool
-
-
-@dataclass(frozen=True)
-class Stations:
-    BATTERSEA_POWER_STATION: Station = Station("940GZZBPSUST", "battersea", "BPS", True)
-    BELSIZE_PARK: Station = Station("940GZZLUBZP", "belsize", "BZP", True)
-    GOLDERS_GREEN: Station = Station("940GZZLUGGN", "golders", "GGN", True)
-    EDGWARE: Station = Station("940GZZLUEGW", "edgware", "EDG", True)
-    KENNINGTON: Station = Station("940GZZLUKNG", "kennington", "KEN", True)
-    MORDEN: Station = Station("940GZZLUMDN", "morden", "MDN", True)
-    EUSTON: Station = Station("940GZZLUEUS", "euston", "EUS", True)
-    HAMPSTEAD_HEATH: Station = Station("910GHMPSTDH", "heath", "HDH", False)
-    STRATFORD: Station = Station("910GSTFD", "stratford", "SRA", False)
-    CLAPHAM_JUNCTION: Station = Station("910GCLPHMJ1", "clapham", "CLJ", False)
-    RICHMOND: Station = Station("910GRICHMND", "richmond", "RMD", False)
-    WILLESDEN_JUNCTION: Station = Station("910GWLSDJHL", "willesden", "WIJ", False)
-    KENSAL_RISE: Station = Station("910GKENR", "kensal rise", "KNR", False)
-    SOUTH_ACTON: Station = Station("910GSACTON", "south acton", "SAT", False)
-    SHEPHERDS_BUSH: Station = Station("910GSHPDSB", "sheps bush", "SPB", False)
-
-
-DUPLICATE_IDS = {"910GCLPHMJC": "910GCLPHMJ1"}
-ID_TO_STATION = {
-    v.station_id: v for k, v in Stations.__dict__.items() if isinstance(v, Station)
-}
-
-DIRECTION_EXCEPTIONS = {
-    "inbound": {
-        Stations.HAMPSTEAD_HEATH.station_id: {Stations.STRATFORD.station_id},
-    },
-    "outbound": {
-        Stations.HAMPSTEAD_HEATH.station_id: {
-            Stations.CLAPHAM_JUNCTION.station_id,
-            Stations.RICHMOND.station_id,
-            Stations.WILLESDEN_JUNCTION.station_id,
-        },
-    },
-}
+    buffer += utf8.decode(b"", final=True)
+    arrivals, end = _decode_each(decoder, buffer, 0)
+    if buffer[end:].strip() not in {"", "]"}:
+        raise ValueError("The arrivals response was truncated")
+
+    for d in arrivals:
+        arrival = _to_arrival(d)
+        if arrival is not None:
+            yield arrival
 
 
 class TFL:
-    def __init__(self):
-        self.pool_manager = urllib3.PoolManager()
+    def __init__(
+        self,
+        pen: Pen | None = None,
+        pool_manager: urllib3.PoolManager | None = None,
+    ):
+        self.pool_manager = pool_manager or urllib3.PoolManager()
         self.app_key = os.environ.get("TFL_APP_KEY")
         if self.app_key is None:
             raise ValueError(
                 "The TFL_APP_KEY environment variable must be set to use the TFL class"
             )
-        self.pen = Pen()
+        self.pen = pen or Pen()
+
+        self.underground = self.pen.load_icon("assets/tfl/underground.png")
+        self.overground = self.pen.load_icon("assets/tfl/overground.png")
+        self.bank = self.pen.load_icon("assets/tfl/bank.png")
+        self.cross = self.pen.load_icon("assets/tfl/cross.png")
+        self.tube = self.pen.load_icon("assets/tfl/tube.png")
+
+        # The background and header only change with the station, so they're drawn once
+        self._get_background = lru_cache(maxsize=32)(self._make_background)
 
-        self.underground = Image.open("assets/tfl/underground.png")
-        self.overground = Image.open("assets/tfl/overground.png")
-        self.bank = Image.open("assets/tfl/bank.png")
-        self.cross = Image.open("assets/tfl/cross.png")
-        self.tube = Image.open("assets/tfl/tube.png")
+        # Arrivals by station, and the requests for them that are in flight
+        self.arrivals = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
 
     @staticmethod
     def _filter_arrivals(arrivals, station_id, inbound):
         filtered_arrivals = []
         direction = "inbound" if inbound else "outbound"
-        exceptions = DIRECTION_EXCEPTIONS[direction].get(station_id, set())
+        exceptions = STATIONS.direction_exceptions(station_id, direction)
         for a in arrivals:
-            a["naptanId"] = DUPLICATE_IDS.get(a["naptanId"], a["naptanId"])
-            a["destinationNaptanId"] = DUPLICATE_IDS.get(
-                a["destinationNaptanId"], a["destinationNaptanId"]
-            )
-            if a["direction"] == direction:
+            if a.direction == direction:
                 filtered_arrivals.append(a)
                 continue
 
-            if a["direction"] == "" and a["destinationNaptanId"] in exceptions:
+            if a.direction == "" and a.destination_naptan_id in exceptions:
                 filtered_arrivals.append(a)
 
-        filtered_arrivals.sort(key=lambda x: x["timeToStation"])
-
-        return filtered_arrivals
+        return heapq.nsmallest(
+            MAX_ARRIVALS, filtered_arrivals, key=lambda x: x.time_to_station
+        )
 
-    def _draw_header(self, image, text, underground):
+    def _make_background(self, text, underground):
+        image = self.pen.new_image(Colours.GRAY)
         roundel = self.underground if underground else self.overground
 
-        image.paste(roundel, (1, 2), roundel)
+        self.pen.draw_icon(image, (1, 2), roundel)
         self.pen.draw_text(
             image=image,
             xy=(roundel.width + 2, 1),
             text=text,
             color=Colours.YELLOW,
         )
+        return image
 
-        time = datetime.now().strftime("%H:%M")
-        time_width = self.pen.text_width(time)
-        self.pen.draw_text(
+    def _draw_header(self, image, colon):
+        self.pen.draw_clock(
             image=image,
-            xy=(63 - time_width, 2),
-            text=time,
+            y=2,
+            now=datetime.now(),
             color=Colours.YELLOW,
+            colon=colon,
         )
 
     def _draw_no_arrivals(self, image, y):
-        image.paste(self.tube, (32 - self.tube.width // 2, y + 10), self.tube)
+        self.pen.draw_icon(image, (32 - self.tube.width // 2, y + 10), self.tube)
 
         y += 10 + self.tube.height
         for text in ["Service", "Closed"]:
@@ -127,42 +194,110 @@ class TFL:
             )
             y += self.pen.letter_height + 1
 
-    def _get_arrivals(self, station_id):
-        url = f"https://api.tfl.gov.uk/StopPoint/{station_id}/Arrivals?APP_KEY={self.app_key}"
+    def _request_arrivals(self, station_ids):
+        url = f"https://api.tfl.gov.uk/StopPoint/{','.join(station_ids)}/Arrivals?APP_KEY={self.app_key}"
         print(url)
         try:
-            response = self.pool_manager.request("GET", url, timeout=5.0)
+            response = self.pool_manager.request(
+                "GET", url, timeout=5.0, preload_content=False
+            )
 
             if response.status != 200:
                 print(f"TfL API Error: {response.status}")
-                return []
+                response.release_conn()
+                return None
 
-            return json.loads(response.data.decode("utf-8"))
+            station_to_arrivals = {station_id: [] for station_id in station_ids}
+            for a in parse_arrivals(response.stream(16384)):
+                station_to_arrivals.setdefault(a.naptan_id, []).append(a)
+            response.release_conn()
+            return station_to_arrivals
 
         except Exception as e:
             print(f"Request failed: {e}")
-            return []
+            return None
+
+    def _get_cached_arrivals(self, station_id):
+        cached = self.arrivals.get(station_id)
+        if cached is None:
+            return None
+
+        fetched_at, arrivals = cached
+        if time.time() - fetched_at >= ARRIVALS_TTL:
+            return None
+        return arrivals
+
+    def _fetch(self, station_ids):
+        # Only one request per station can be in flight, later callers wait for it
+        results = {}
+        futures = {}
+        missing_ids = []
+        with self.lock:
+            for station_id in station_ids:
+                arrivals = self._get_cached_arrivals(station_id)
+                if arrivals is not None:
+                    results[station_id] = arrivals
+                    continue
+
+                if station_id not in self.in_flight:
+                    self.in_flight[station_id] = Future()
+                    missing_ids.append(station_id)
+                futures[station_id] = self.in_flight[station_id]
+
+        station_to_arrivals = None
+        try:
+            if missing_ids:
+                with span("fetch_tfl"):
+                    station_to_arrivals = self._request_arrivals(missing_ids)
+        finally:
+            now = time.time()
+            with self.lock:
+                for station_id in missing_ids:
+                    future = self.in_flight.pop(station_id)
+                    if station_to_arrivals is None:
+                        future.set_result(None)
+                        continue
+
+                    arrivals = station_to_arrivals[station_id]
+                    self.arrivals[station_id] = (now, arrivals)
+                    future.set_result(arrivals)
+
+        for station_id, future in futures.items():
+            results[station_id] = future.result()
+        return results
+
+    def prefetch(self, station_ids: list[str]):
+        # Fetch several stations with one request, using the multi-ID StopPoint endpoint
+        return self._fetch(sorted(set(station_ids)))
 
-    def get_and_filter_arrivals(self, station_id: str, inbound: bool) -> list[dict]:
+    def _get_arrivals(self, station_id):
+        arrivals = self._fetch([station_id])[station_id]
+        return arrivals or []
+
+    def get_and_filter_arrivals(self, station_id: str, inbound: bool) -> list[Arrival]:
         arrivals = self._get_arrivals(station_id)
         arrivals = self._filter_arrivals(arrivals, station_id, inbound)
         return arrivals
 
     def make_image(
-        self, arrivals: list[dict], header_text: str, underground: bool
+        self,
+        arrivals: list[Arrival],
+        header_text: str,
+        underground: bool,
+        colon: bool = True,
     ) -> Image:
-        image = Image.new("RGB", (64, 64), color=Colours.GRAY)
+        image = self._get_background(header_text, underground).copy()
 
-        self._draw_header(image, header_text, underground)
+        self._draw_header(image, colon)
 
         # height of the header + 4 spaces
         y = self.pen.letter_height + 4
         for arrival in arrivals:
             try:
-                nickname = ID_TO_STATION[arrival["destinationNaptanId"]].nickname
+                nickname = STATIONS[arrival.destination_naptan_id].nickname
             except KeyError:
                 print(f"Arrival is not a listed station: {arrival}")
-                nickname = arrival["destinationName"].split()[0][:3]
+                nickname = arrival.destination_name.split()[0][:3]
             left_text = nickname.capitalize()
             left_width = self.pen.text_width(left_text)
             self.pen.draw_text(
@@ -172,12 +307,12 @@ class TFL:
                 color=Colours.YELLOW,
             )
 
-            if "via CX" in arrival["towards"]:
-                image.paste(self.cross, (left_width + 2, y), self.cross)
-            elif "via Bank" in arrival["towards"]:
-                image.paste(self.bank, (left_width + 2, y), self.bank)
+            if "via CX" in arrival.towards:
+                self.pen.draw_icon(image, (left_width + 2, y), self.cross)
+            elif "via Bank" in arrival.towards:
+                self.pen.draw_icon(image, (left_width + 2, y), self.bank)
 
-            mins_to_station = str(arrival["timeToStation"] // 60)
+            mins_to_station = str(arrival.time_to_station // 60)
             text_width = self.pen.text_width(mins_to_station)
             self.pen.draw_text(
                 image=image,
@@ -198,12 +333,26 @@ class TFL:
 
         return image
 
+    def make_frames(
+        self,
+        arrivals: list[Arrival],
+        header_text: str,
+        underground: bool,
+        animate: bool = False,
+    ) -> list[Image]:
+        colons = [True, False] if animate else [True]
+        with span("render"):
+            return [
+                self.make_image(arrivals, header_text, underground, colon)
+                for colon in colons
+            ]
+
 
 def main():
     from my_config import belsize_message
 
     tfl = TFL()
-    station = ID_TO_STATION[belsize_message.station_id]
+    station = STATIONS[belsize_message.station_id]
     image = tfl.make_image(
         arrivals=tfl.get_and_filter_arrivals(
             station.station_id, belsize_message.inbound
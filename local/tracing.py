@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+import time
+
+# The namespace of the metrics, when they're logged in CloudWatch's embedded metric format
+NAMESPACE = "Pixoo"
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Tracer:
+    def __init__(self, format: str | None = None, sink=print):
+        if format not in {None, "json", "emf"}:
+            raise ValueError(f'Trace format "{format}" is not supported')
+
+        self.format = format
+        self.sink = sink
+        self.spans = []
+        # Spans are recorded by the fetch threads too
+        self.lock = threading.Lock()
+
+    def span(self, name: str):
+        # Tracing is off by default, so this is the only cost on the hot path
+        if self.format is None:
+            return NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name: str, seconds: float):
+        with self.lock:
+            self.spans.append((name, seconds))
+
+    def flush(self, **fields):
+        with self.lock:
+            spans, self.spans = self.spans, []
+        if self.format is None or not spans:
+            return
+
+        # Stages that ran several times (i.e. one cache get per key) are summed
+        timings = {}
+        for name, seconds in spans:
+            timings[name] = timings.get(name, 0.0) + round(1e3 * seconds, 3)
+
+        if self.format == "json":
+            self.sink(json.dumps({**fields, "spans": timings}))
+            return
+
+        self.sink(
+            json.dumps(
+                {
+                    "_aws": {
+                        "Timestamp": int(1e3 * time.time()),
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": NAMESPACE,
+                                "Dimensions": [list(fields)],
+                                "Metrics": [
+                                    {"Name": name, "Unit": "Milliseconds"}
+                                    for name in timings
+                                ],
+                            }
+                        ],
+                    },
+                    **fields,
+                    **timings,
+                }
+            )
+        )
+
+
+tracer = Tracer(os.environ.get("TRACE_FORMAT"))
+span = tracer.span
@@ -1,21 +1,38 @@
+import calendar
 import json
 import os
-import re
+import threading
+import time
+from bisect import bisect_right
 from datetime import datetime, timedelta
+from functools import cached_property, partial
 from urllib.parse import urlencode
 
 import urllib3
+from cache import Cache, make_cache
+from fetch import executor, gather
+from html_table import find_row
 from pen import Colours, Pen
-from PIL import Image
-from s3_cache import S3Cache
+from tracing import span
+
+# Seconds before a location's forecast is fetched again, each one covers a few days
+FORECAST_REFRESH = 6 * 3600
+POND_KEY = "pond.json"
+# Seconds between attempts to refresh the pond temperature, as it's posted once a day
+POND_RETRY = 900
 
 
 class Weather:
-    def __init__(self, cache: S3Cache):
+    def __init__(
+        self,
+        cache: Cache,
+        pen: Pen | None = None,
+        pool_manager: urllib3.PoolManager | None = None,
+    ):
         self.cache = cache
 
-        self.pool_manager = urllib3.PoolManager()
-        self.pen = Pen()
+        self.pool_manager = pool_manager or urllib3.PoolManager()
+        self.pen = pen or Pen()
         self.api_key = os.environ.get("MET_OFFICE_API_KEY")
         if self.api_key is None:
             raise ValueError(
@@ -25,23 +42,41 @@ class Weather:
         self.now = None
         self.now_timestamp = None
 
-        self.rain = Image.open("assets/weather/rain.png")
-        self.duck = Image.open("assets/weather/duck.png")
-        self.thermometer = Image.open("assets/weather/thermometer.png")
-        self.droplet = Image.open("assets/weather/droplet.png")
+        self.pond_refresh = None
+        self.pond_checked = 0.0
+        self.lock = threading.Lock()
+
+        self.rain = self.pen.load_icon("assets/weather/rain.png")
+        self.duck = self.pen.load_icon("assets/weather/duck.png")
+        self.thermometer = self.pen.load_icon("assets/weather/thermometer.png")
+        self.droplet = self.pen.load_icon("assets/weather/droplet.png")
 
     def _update_now(self):
         self.now = datetime.now()
         self.now_timestamp = self.now.timestamp()
 
-    def _get_weather(self, lat, lon):
-        key = f"weather_lat={lat}_lon={lon}.json"
-        weather, last_updated = self.cache.get(key)
-        if last_updated is not None:
-            recently_checked = (self.now_timestamp - last_updated) < 3600
-            if recently_checked:
-                return weather
+    @staticmethod
+    def _to_columns(time_series):
+        # One list per parameter, so the cache doesn't repeat every name for every hour
+        names = sorted({name for step in time_series for name in step} - {"time"})
+        return {
+            "times": [
+                calendar.timegm(time.strptime(step["time"], "%Y-%m-%dT%H:%MZ"))
+                for step in time_series
+            ],
+            "columns": {
+                name: [step.get(name) for step in time_series] for name in names
+            },
+        }
+
+    def _hour_index(self, forecast):
+        times = forecast.get("times", [])
+        i = bisect_right(times, self.now_timestamp) - 1
+        if i < 0 or self.now_timestamp - times[i] >= 3600:
+            return None
+        return i
 
+    def _request_forecast(self, lat, lon):
         timesteps = "hourly"
         params = {
             "excludeParameterMetadata": "true",
@@ -58,55 +93,139 @@ class Weather:
             "apikey": self.api_key,
         }
 
-        response = self.pool_manager.request("GET", full_url, headers=headers)
+        response = self.pool_manager.request(
+            "GET", full_url, headers=headers, timeout=5.0
+        )
         if response.status != 200:
             print(f"Error: {response.status}")
             print(response.data.decode("utf-8"))
             return None
 
         data = json.loads(response.data.decode("utf-8"))
-        weather = data["features"][0]["properties"]["timeSeries"][0]
+        return data["features"][0]["properties"]["timeSeries"]
 
-        self.cache.save(weather, key)
+    def _get_forecast(self, lat, lon):
+        key = f"forecast_lat={lat}_lon={lon}.json"
+        forecast, last_updated = self.cache.get(key)
+        if last_updated is not None and self._hour_index(forecast) is not None:
+            recently_checked = (self.now_timestamp - last_updated) < FORECAST_REFRESH
+            if recently_checked:
+                return forecast
 
-        return weather
+        with span("fetch_forecast"):
+            time_series = self._request_forecast(lat, lon)
+        if not time_series:
+            # An older forecast is better than nothing, as long as it covers this hour
+            return forecast if self._hour_index(forecast) is not None else None
 
-    def _get_pond_temperature(self):
-        key = "pond_temperature.json"
-        temperature, last_updated = self.cache.get(key)
-        if last_updated is not None:
-            recently_checked = (self.now_timestamp - last_updated) < 3600
-            if recently_checked and False:
-                return temperature
-
-        response = self.pool_manager.request("GET", "https://nw3weather.co.uk/wxdataday.php?vartype=pond")
-        data = response.data.decode("utf-8")
-        if response.status != 200:
-            print(f"Error: {response.status}")
-            print(data)
-            return -99
+        forecast = self._to_columns(time_series)
+        self.cache.save(forecast, key)
 
-        yesterday = self.now - timedelta(days=1)
-        rows = data.split('<tr>')
-        for row in rows:
-            if f'>{yesterday.day!s}</td>' not in row:
-                continue
+        return forecast
 
-            cells = row.split('</td>')
-            if len(cells) <= yesterday.month:
-                continue
+    def _get_weather(self, lat, lon):
+        forecast = self._get_forecast(lat, lon)
+        i = None if forecast is None else self._hour_index(forecast)
+        if i is None:
+            return None
 
-            target_cell = cells[yesterday.month]
+        return {name: column[i] for name, column in forecast["columns"].items()}
 
-            value = re.sub('<[^<]+?>', '', target_cell).replace('&nbsp;', '').strip()
-            if value and value != "-":
-                temperature = round(float(value))
-                self.cache.save(temperature, key)
-                return temperature
+    def prefetch(self, locations: list[tuple[str, str]]):
+        # Refresh the forecasts for several locations at once
+        self._update_now()
+        gather(
+            *[
+                partial(self._get_forecast, lat, lon)
+                for lat, lon in sorted(set(locations))
+            ]
+        )
 
-        return -99
+    def _scrape_pond_temperature(self, day):
+        response = self.pool_manager.request(
+            "GET",
+            "https://nw3weather.co.uk/wxdataday.php?vartype=pond",
+            timeout=5.0,
+            preload_content=False,
+        )
+        try:
+            if response.status != 200:
+                print(f"Error: {response.status}")
+                print(response.data.decode("utf-8"))
+                return None
+
+            # Each row is a day of the month, and each column after the day is a month
+            cells = find_row(response.stream(16384), first_cell=str(day.day))
+        finally:
+            response.close()
+
+        if cells is None or len(cells) <= day.month:
+            return None
+
+        value = cells[day.month]
+        if value and value != "-":
+            return round(float(value))
+
+        return None
+
+    def _refresh_pond_temperature(self, day):
+        try:
+            with span("fetch_pond"):
+                temperature = self._scrape_pond_temperature(day)
+        except Exception as e:
+            print(f"Failed to refresh the pond temperature: {e}")
+            return None
+
+        # Failures keep the last good temperature in the cache
+        if temperature is not None:
+            self.cache.save(
+                {"date": day.isoformat(), "temperature": temperature}, POND_KEY
+            )
+        return temperature
 
-    def _draw_header(self, image):
+    def _start_pond_check(self):
+        with self.lock:
+            refreshing = self.pond_refresh is not None and not self.pond_refresh.done()
+            if refreshing or time.time() - self.pond_checked < POND_RETRY:
+                return False
+
+            self.pond_checked = time.time()
+            return True
+
+    def _get_pond_temperature(self):
+        # The pond temperature is yesterday's reading, so it changes once a day
+        yesterday = (self.now - timedelta(days=1)).date()
+        pond, _ = self.cache.get(POND_KEY)
+        if pond.get("date") == yesterday.isoformat():
+            return pond["temperature"]
+
+        if "temperature" in pond:
+            # Show the stale temperature, and refresh it off the critical path
+            if self._start_pond_check():
+                self.pond_refresh = executor.submit(
+                    self._refresh_pond_temperature, yesterday
+                )
+            return pond["temperature"]
+
+        # There's nothing to show yet, so this frame has to wait for the scrape
+        if not self._start_pond_check():
+            return -99
+        temperature = self._refresh_pond_temperature(yesterday)
+        return -99 if temperature is None else temperature
+
+    def _icons(self):
+        row_1_y = 35 + self.pen.letter_height // 2
+        return [
+            [1, row_1_y, self.thermometer, "screenTemperature"],
+            [33, row_1_y, self.duck, "pondTemperature"],
+            [1, 64, self.rain, "probOfPrecipitation"],
+            [33, 64, self.droplet, "screenRelativeHumidity"],
+        ]
+
+    @cached_property
+    def background(self):
+        # The title and icons never change, so they're drawn once
+        image = self.pen.new_image(Colours.GRAY)
         text = "Weather"
         self.pen.draw_text(
             image=image,
@@ -115,35 +234,37 @@ class Weather:
             color=Colours.WHITE,
         )
 
-        time = datetime.now().strftime("%H:%M")
-        time_width = self.pen.text_width(time)
-        self.pen.draw_text(
+        for x, y, icon, _ in self._icons():
+            self.pen.draw_icon(image, (x + (32 - icon.width) // 2, y - self.pen.letter_height - icon.height - 2), icon)
+        return image
+
+    def _draw_header(self, image, colon):
+        self.pen.draw_clock(
             image=image,
-            xy=(63 - time_width, 4),
-            text=time,
+            y=4,
+            now=self.now,
             color=Colours.WHITE,
+            colon=colon,
         )
 
-    def make_image(self, lat: str, lon: str):
+    def _get_data(self, lat, lon):
         self._update_now()
-        weather = self._get_weather(lat, lon)
+        # The forecast and the pond temperature are independent, so fetch them at once
+        weather, pond_temperature = gather(
+            lambda: self._get_weather(lat, lon),
+            self._get_pond_temperature,
+        )
 
-        pond_temperature = self._get_pond_temperature()
         if pond_temperature is not None:
             weather["pondTemperature"] = pond_temperature
 
-        image = Image.new("RGB", (64, 64), color=Colours.GRAY)
-        self._draw_header(image)
+        return weather
 
-        row_1_y = 35 + self.pen.letter_height // 2
-        for x, y, icon, key in [
-            [1, row_1_y, self.thermometer, "screenTemperature"],
-            [33, row_1_y, self.duck, "pondTemperature"],
-            [1, 64, self.rain, "probOfPrecipitation"],
-            [33, 64, self.droplet, "screenRelativeHumidity"],
-        ]:
-            image.paste(icon, (x + (32 - icon.width) // 2, y - self.pen.letter_height - icon.height - 2), icon)
+    def _render(self, weather, colon=True):
+        image = self.background.copy()
+        self._draw_header(image, colon)
 
+        for x, y, _, key in self._icons():
             text = str(int(weather[key]))
             if key in {"pondTemperature", "screenTemperature"}:
                 text += "°"
@@ -154,11 +275,21 @@ class Weather:
 
         return image
 
+    def make_image(self, lat: str, lon: str):
+        weather = self._get_data(lat, lon)
+        return self._render(weather)
+
+    def make_frames(self, lat: str, lon: str, animate: bool = False):
+        weather = self._get_data(lat, lon)
+        colons = [True, False] if animate else [True]
+        with span("render"):
+            return [self._render(weather, colon) for colon in colons]
+
 
 def main():
     from my_config import weather_message
 
-    cache = S3Cache()
+    cache = make_cache()
     weather = Weather(cache)
     image = weather.make_image(weather_message.lat, weather_message.lon)
     image.save("../weather.png")